@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+from rocket_lander import RocketLander, load_pygame
+
+# cycle of actions that keeps the rocket flying for a while instead of dropping straight down
+ACTION_CYCLE = [1, 0, 0, 2, 0, 0, 1, 0, 0, 3, 0, 0]
+# thrusting a quarter of the time, the rocket sinks towards the pad instead of climbing away
+DESCENT_CYCLE = [1, 0, 0, 0, 2, 0, 0, 0, 1, 0, 0, 0, 3, 0, 0, 0]
+BENCHMARKS = ["step", "overhead", "reset", "render", "vec_env", "ppo", "cold_start", "free_flight", "profiles"]
+# handover altitude of the hybrid engine and the booster position error allowed at handover
+FREE_FLIGHT_ALTITUDE = 20. #m
+FREE_FLIGHT_TOLERANCE = 0.5 #m
+# time to first step allowed for a fresh interpreter that only steps the physics
+COLD_START_BUDGET = 1.0 #in seconds
+# run in a fresh interpreter: imports the module, then builds a headless lander and steps it once
+COLD_START_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from rocket_lander import RocketLander
+env = RocketLander(render_mode = None)
+env.reset(seed = 0)
+env.step(0)
+first_step = time.perf_counter()
+heavy_modules = [name for name in ["pygame", "stable_baselines3", "torch"] if name in sys.modules]
+print(json.dumps({{"import_s": imported - start, "first_step_s": first_step - start, "heavy_modules": heavy_modules}}))
+"""
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--steps", help="Number of environment steps every measurement runs for", default=20000, type=int)
+    parser.add_argument("-b", "--benchmarks", help="Benchmarks to run", default=BENCHMARKS, nargs="+", choices=BENCHMARKS)
+    parser.add_argument("-e", "--max_envs", help="Largest number of environments the vector env scaling goes up to", default=os.cpu_count(), type=int)
+    parser.add_argument("-t", "--ppo_timesteps", help="Number of timesteps the PPO benchmark learns for", default=32768, type=int)
+    parser.add_argument("-c", "--cold_start_budget", help="Seconds a fresh worker may take to its first step", default=COLD_START_BUDGET, type=float)
+    parser.add_argument("-m", "--model", help="Policy (.zip or .npz) flying the profiles benchmark, an open loop descent when not given", default=None, type=str)
+    parser.add_argument("-o", "--output", help="JSON file the results are written to, printed when not given", default=None, type=str)
+
+    return parser.parse_args()
+
+def machine_info():
+    info = {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+    }
+    for module in ["pymunk", "gymnasium", "pygame", "stable_baselines3", "torch"]:
+        try:
+            info[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            info[module] = None
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        info["commit"] = None
+
+    return info
+
+def bench_step(steps):
+    env = RocketLander(render_mode = None)
+    env.reset(seed = 0)
+    step_time = 0.
+    for i in range(steps):
+        start = time.perf_counter()
+        _, _, terminated, _, _ = env.step(ACTION_CYCLE[i % len(ACTION_CYCLE)])
+        step_time += time.perf_counter() - start
+        if terminated:
+            env.reset(seed = i)
+    env.close()
+
+    return {"steps_per_second": steps/step_time}
+
+def bench_step_overhead(steps, observation_views = False):
+    # Times RocketLander.step next to the bare space.step calls made inside it, whatever
+    # is left is the python overhead of inputs, collisions, observations and reward.
+    env = RocketLander(render_mode = None, observation_views = observation_views)
+    env.reset(seed = 0)
+    space_time = 0.
+    space_step = env.space.step
+    def timed_space_step(dt):
+        nonlocal space_time
+        start = time.perf_counter()
+        space_step(dt)
+        space_time += time.perf_counter() - start
+    env.space.step = timed_space_step
+
+    step_time = 0.
+    for i in range(steps):
+        start = time.perf_counter()
+        _, _, terminated, _, _ = env.step(ACTION_CYCLE[i % len(ACTION_CYCLE)])
+        step_time += time.perf_counter() - start
+        if terminated:
+            # the physics step run inside reset is not part of the measurement
+            reset_space_time = space_time
+            env.reset(seed = i)
+            space_time = reset_space_time
+    env.close()
+
+    return {
+        "step_us": 1e6*step_time/steps,
+        "space_step_us": 1e6*space_time/steps,
+        "overhead_us": 1e6*(step_time - space_time)/steps,
+    }
+
+def bench_reset(resets):
+    env = RocketLander(render_mode = None)
+    latencies = np.empty(resets)
+    for i in range(resets):
+        start = time.perf_counter()
+        env.reset(seed = i)
+        latencies[i] = time.perf_counter() - start
+    env.close()
+
+    return {"mean_us": 1e6*latencies.mean(), "p50_us": 1e6*np.median(latencies), "p99_us": 1e6*np.percentile(latencies, 99)}
+
+def bench_render(frames):
+    # draws into an offscreen surface, no window is ever opened
+    pygame = load_pygame()
+    env = RocketLander(render_mode = None)
+    env.reset(seed = 0)
+    surface = pygame.Surface(RocketLander.WINDOW_RESOLUTION)
+    env.camera.position = env.rocket.position
+    frame_time = 0.
+    for i in range(frames):
+        _, _, terminated, _, _ = env.step(ACTION_CYCLE[i % len(ACTION_CYCLE)])
+        if terminated:
+            env.reset(seed = i)
+        start = time.perf_counter()
+        env.draw(surface)
+        frame_time += time.perf_counter() - start
+    env.close()
+
+    return {"frame_us": 1e6*frame_time/frames, "frames_per_second": frames/frame_time}
+
+def bench_vec_env(steps, max_envs):
+    from vec_env import RocketLanderVecEnv, SharedMemoryVecEnv
+    env_counts = []
+    num_envs = 1
+    while num_envs < max_envs:
+        env_counts.append(num_envs)
+        num_envs *= 2
+    env_counts.append(max_envs)
+
+    results = {"in_process": {}, "shared_memory": {}}
+    for num_envs in env_counts:
+        for kind, make_env in [("in_process", lambda: RocketLanderVecEnv(num_envs)), ("shared_memory", lambda: SharedMemoryVecEnv(num_envs))]:
+            envs = make_env()
+            envs.seed(0)
+            envs.reset()
+            vec_steps = max(1, steps//num_envs)
+            start = time.perf_counter()
+            for i in range(vec_steps):
+                envs.step(np.full(num_envs, ACTION_CYCLE[i % len(ACTION_CYCLE)]))
+            elapsed = time.perf_counter() - start
+            envs.close()
+            results[kind][num_envs] = {"steps_per_second": num_envs*vec_steps/elapsed}
+
+    return results
+
+def bench_ppo(timesteps, num_envs = 16):
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.vec_env import VecMonitor
+    from vec_env import RocketLanderVecEnv
+    from trainer import Trainer
+    envs = VecMonitor(RocketLanderVecEnv(num_envs))
+    model = PPO(policy = 'MlpPolicy', env = envs, seed = 0, **dict(Trainer.PPO_PARAMETERS, verbose = 0, device = "cpu"))
+    start = time.perf_counter()
+    model.learn(total_timesteps = timesteps)
+    elapsed = time.perf_counter() - start
+    envs.close()
+
+    return {"timesteps_per_second": model.num_timesteps/elapsed, "num_envs": num_envs}
+
+def bench_cold_start(budget, runs = 5):
+    # Median over fresh interpreters of the time to import a module and take a first step,
+    # process startup included. workers is what every vec env worker loads, trainer is what
+    # the main script and, re-imported, every spawned child loads.
+    results = {}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in ["rocket_lander", "workers", "trainer"]:
+        measurements = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT.format(module = module)], capture_output=True, text=True, check=True, cwd=directory).stdout
+            measurement = json.loads(output)
+            measurement["process_s"] = time.perf_counter() - start
+            measurements.append(measurement)
+        results[module] = {
+            "import_s": float(np.median([measurement["import_s"] for measurement in measurements])),
+            "first_step_s": float(np.median([measurement["first_step_s"] for measurement in measurements])),
+            "process_s": float(np.median([measurement["process_s"] for measurement in measurements])),
+            "heavy_modules": measurements[0]["heavy_modules"],
+        }
+        results[module]["within_budget"] = results[module]["process_s"] <= budget
+
+    return results
+
+def bench_free_flight(episodes, max_steps = 5000, altitude = FREE_FLIGHT_ALTITUDE, tolerance = FREE_FLIGHT_TOLERANCE):
+    # Flies the same seeds and actions with pure pymunk and with the hybrid free flight engine.
+    # Reports the speed of both, how far the hybrid booster drifted from the reference by the
+    # time it handed over to pymunk, and how often both episodes ended the same way.
+    reference = RocketLander(render_mode = None)
+    hybrid = RocketLander(render_mode = None, free_flight_altitude = altitude)
+    times = {"reference": 0., "hybrid": 0.}
+    steps = {"reference": 0, "hybrid": 0}
+    position_errors = []
+    velocity_errors = []
+    agreements = 0
+    for episode in range(episodes):
+        reference.reset(seed = episode)
+        hybrid.reset(seed = episode)
+        reference_done = hybrid_done = False
+        for i in range(max_steps):
+            action = DESCENT_CYCLE[i % len(DESCENT_CYCLE)]
+            was_free_flying = hybrid.free_flying
+            if not reference_done:
+                start = time.perf_counter()
+                _, _, reference_done, _, _ = reference.step(action)
+                times["reference"] += time.perf_counter() - start
+                steps["reference"] += 1
+            if not hybrid_done:
+                start = time.perf_counter()
+                _, _, hybrid_done, _, _ = hybrid.step(action)
+                times["hybrid"] += time.perf_counter() - start
+                steps["hybrid"] += 1
+            if was_free_flying and not hybrid.free_flying and not reference_done:
+                position_errors.append(float((reference.rocket.position - hybrid.rocket.position).length))
+                velocity_errors.append(float((reference.rocket.velocity - hybrid.rocket.velocity).length))
+            if reference_done and hybrid_done:
+                break
+        agreements += reference.outcome == hybrid.outcome
+    reference.close()
+    hybrid.close()
+
+    max_position_error = max(position_errors, default=0.)
+    return {
+        "reference_steps_per_second": steps["reference"]/times["reference"],
+        "hybrid_steps_per_second": steps["hybrid"]/times["hybrid"],
+        "handovers": len(position_errors),
+        "max_handover_position_error_m": max_position_error,
+        "max_handover_velocity_error_m_s": max(velocity_errors, default=0.),
+        "outcome_agreement": agreements/episodes,
+        "within_tolerance": max_position_error <= tolerance,
+    }
+
+def load_policy(path):
+    if path.endswith(".npz"):
+        from numpy_policy import NumpyPolicy
+        return NumpyPolicy(path)
+    from stable_baselines3 import PPO
+    return PPO.load(path, device = "cpu")
+
+def bench_profiles(episodes, model = None, max_steps = 5000):
+    # Flies the same seeds under every simulation profile, with the policy when one is given.
+    # Outcome agreement is the share of seeds ending like they do under "accurate", a profile
+    # that keeps it at 1 doesn't change what the policy does. Inference is not timed.
+    policy = None if model is None else load_policy(model)
+    results = {}
+    reference_outcomes = None
+    for name in RocketLander.SIMULATION_PROFILES:
+        env = RocketLander(render_mode = None, simulation_profile = name)
+        outcomes = []
+        rewards = []
+        step_time = 0.
+        steps = 0
+        for episode in range(episodes):
+            observations, _ = env.reset(seed = episode)
+            episode_reward = 0.
+            for i in range(max_steps):
+                if policy is None:
+                    action = DESCENT_CYCLE[i % len(DESCENT_CYCLE)]
+                else:
+                    action = int(policy.predict(observations, deterministic = True)[0])
+                start = time.perf_counter()
+                observations, reward, terminated, _, _ = env.step(action)
+                step_time += time.perf_counter() - start
+                steps += 1
+                episode_reward += reward
+                if terminated:
+                    break
+            outcomes.append(env.outcome)
+            rewards.append(episode_reward)
+        env.close()
+        if reference_outcomes is None:
+            reference_outcomes = outcomes
+        results[name] = {
+            "steps_per_second": steps/step_time,
+            "simulated_seconds_per_second": steps*env.step_time/step_time,
+            "mean_reward": float(np.mean(rewards)),
+            "landing_rate": outcomes.count("landed")/episodes,
+            "outcome_agreement": float(np.mean([outcome == reference for outcome, reference in zip(outcomes, reference_outcomes)])),
+        }
+
+    return results
+
+def run_benchmarks(benchmarks, steps, max_envs, ppo_timesteps, cold_start_budget = COLD_START_BUDGET, model = None):
+    results = {"machine": machine_info(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": {}}
+    for benchmark in benchmarks:
+        match benchmark:
+            case "step":
+                result = bench_step(steps)
+            case "overhead":
+                result = {"copy": bench_step_overhead(steps, False), "views": bench_step_overhead(steps, True)}
+            case "reset":
+                result = bench_reset(max(1, steps//10))
+            case "render":
+                result = bench_render(max(1, steps//10))
+            case "vec_env":
+                result = bench_vec_env(steps, max_envs)
+            case "ppo":
+                result = bench_ppo(ppo_timesteps)
+            case "cold_start":
+                result = bench_cold_start(cold_start_budget)
+            case "free_flight":
+                result = bench_free_flight(max(1, steps//500))
+            case "profiles":
+                result = bench_profiles(max(1, steps//500), model)
+        results["results"][benchmark] = result
+        print(f"{benchmark}: {json.dumps(result)}", file=sys.stderr)
+
+    return results
+
+if __name__ == "__main__":
+    args = get_arguments()
+    results = run_benchmarks(args.benchmarks, args.steps, args.max_envs, args.ppo_timesteps, args.cold_start_budget, args.model)
+    if args.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
@@ -0,0 +1,15 @@
+from stable_baselines3.common.callbacks import BaseCallback
+from rocket_lander import PhaseTimer
+
+
+class PerfStatsCallback(BaseCallback):
+
+    # logs the step phase timings of all sub envs, added up, at the end of every rollout
+    def _on_step(self):
+        return True
+
+    def _on_rollout_end(self):
+        stats = PhaseTimer.merge(self.training_env.env_method("perf_stats", reset=True))
+        for phase, phase_stats in stats.items():
+            self.logger.record(f"perf/{phase}_mean_us", phase_stats["mean_us"])
+            self.logger.record(f"perf/{phase}_total_s", phase_stats["total_s"])
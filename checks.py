@@ -0,0 +1,194 @@
+import sys
+import argparse
+import resource
+from rocket_lander import RocketLander
+from benchmark import FREE_FLIGHT_ALTITUDE, FREE_FLIGHT_TOLERANCE
+
+# Assertion based checks of the simulator guarantees other code relies on, a failed check
+# exits with an error. Every check flies seeded episodes and compares runs step by step.
+# the rocket falls freely until it sinks faster than this, then thrusts, gimballed against its tilt
+DESCENT_VELOCITY = 4 #m/s
+CHECKS = ["reset", "snapshot", "free_flight", "restore_memory"]
+# peak memory repeated restores may add once warmed up, the arbiters and contact buffers they
+# need are reused, a few KB leaked per restore would exceed it many times over
+RESTORE_MEMORY_GROWTH = 1024 #KB
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--checks", help="Checks to run", default=CHECKS, nargs="+", choices=CHECKS)
+    parser.add_argument("-e", "--episodes", help="Number of seeded episodes every check flies", default=20, type=int)
+
+    return parser.parse_args()
+
+def descend(observations):
+    # crude controller that lands about half of the seeds and crashes the rest, so the
+    # checks go through free flight, leg contacts, landings and crashes alike
+    if observations[3]*100 < DESCENT_VELOCITY:
+        return 0
+    tilt = observations[4] + 0.5*observations[5]
+    if tilt > 0.02:
+        return 3
+    if tilt < -0.02:
+        return 2
+    return 1
+
+def fly(env, seed, max_steps = 8000):
+    # observations and rewards of one seeded episode
+    observations, _ = env.reset(seed = seed)
+    trajectory = [observations.tolist()]
+    for i in range(max_steps):
+        observations, reward, terminated, _, _ = env.step(descend(observations))
+        trajectory.append(observations.tolist() + [reward])
+        if terminated:
+            break
+    return trajectory
+
+def assert_same(expected, actual, what):
+    assert len(expected) == len(actual), f"{what}: {len(actual)} steps instead of {len(expected)}"
+    for step, (expected_step, actual_step) in enumerate(zip(expected, actual)):
+        assert expected_step == actual_step, f"{what}: diverged at step {step}, {actual_step} instead of {expected_step}"
+
+def check_reset(episodes):
+    # a seeded reset of a lander that already flew other episodes replays the newly built world exactly
+    reused = RocketLander(render_mode = None)
+    for seed in range(episodes):
+        fresh = RocketLander(render_mode = None)
+        assert_same(fly(fresh, seed), fly(reused, seed), f"reset with seed {seed}")
+        fresh.close()
+    reused.close()
+
+def continuation(lander, policy, horizon):
+    # observations, rewards, contact bookkeeping and episode summaries of the next steps of a lander
+    steps = []
+    for i in range(horizon):
+        observations, reward, terminated, _, _ = lander.step(policy(i, lander.observations))
+        steps.append(observations.tolist() + [reward, lander.contact_time] + list(lander.rocket.contacts) + list(lander.planet.contacts)
+                     + list(lander.episode_summary().values()) + [lander.episode_return, lander.episode_length])
+        if terminated:
+            break
+    return steps
+
+def check_fork(original, policy, horizon, what):
+    # a clone continues exactly like the original, and so does the original once it is put
+    # back where it was, which it is afterwards
+    state = original.get_state()
+    observations = original.observations.copy()
+    fork = original.clone()
+    expected = continuation(original, policy, horizon)
+    assert_same(expected, continuation(fork, policy, horizon), what)
+    # snapshots leave the observations out, the policy reads them like clone copies them
+    original.set_state(state)
+    original.observations[:] = observations
+    assert_same(expected, continuation(original, policy, horizon), f"{what}, restored in place")
+    original.set_state(state)
+    original.observations[:] = observations
+    fork.close()
+
+def check_snapshot(episodes, interval = 150, horizon = 400, hop = [1]*12 + [0]*40, max_steps = 8000, free_flight_altitude = None, simulation_profile = "accurate"):
+    # a clone taken at any step continues exactly like the lander it was taken from, in flight,
+    # with the legs on the ground and while they lift off again
+    lander = RocketLander(render_mode = None, free_flight_altitude = free_flight_altitude, simulation_profile = simulation_profile)
+    for seed in range(episodes):
+        observations, _ = lander.reset(seed = seed)
+        touched = None
+        for step in range(max_steps):
+            if step and step % interval == 0:
+                check_fork(lander, lambda i, observations: descend(observations), horizon, f"{simulation_profile} clone of seed {seed} at step {step}")
+            observations, _, terminated, _, _ = lander.step(descend(observations))
+            if touched is None and observations[6] and observations[7]:
+                touched = step
+            if terminated:
+                break
+        if touched is None:
+            continue
+        # settles on the legs, then hops off the ground, forking at every step of the hop
+        lander.reset(seed = seed)
+        for step in range(touched + 1):
+            lander.step(descend(lander.observations))
+        for step in range(40):
+            lander.step(0)
+        for start in range(len(hop)):
+            check_fork(lander, lambda i, observations: hop[start+i], len(hop) - start, f"{simulation_profile} clone of seed {seed} at step {start} of the hop")
+            lander.step(hop[start])
+    lander.close()
+
+def check_free_flight(episodes, max_steps = 8000):
+    # the hybrid engine hands the booster and legs over to pymunk close to where pure pymunk
+    # flew them, given the same actions, and snapshots taken while it free flies are as exact as others
+    reference = RocketLander(render_mode = None)
+    hybrid = RocketLander(render_mode = None, free_flight_altitude = FREE_FLIGHT_ALTITUDE)
+    handovers = 0
+    for seed in range(episodes):
+        observations, _ = reference.reset(seed = seed)
+        hybrid.reset(seed = seed)
+        for step in range(max_steps):
+            action = descend(observations)
+            observations, _, terminated, _, _ = reference.step(action)
+            was_free_flying = hybrid.free_flying
+            hybrid.step(action)
+            if was_free_flying and not hybrid.free_flying:
+                bodies = [[rocket, rocket.leg_body_l, rocket.leg_body_r] for rocket in [reference.rocket, hybrid.rocket]]
+                error = max((expected.position - actual.position).length for expected, actual in zip(*bodies))
+                assert error <= FREE_FLIGHT_TOLERANCE, f"free flight of seed {seed}: handed over {error:.3f} m away from pymunk, more than {FREE_FLIGHT_TOLERANCE} m"
+                handovers += 1
+                break
+            if terminated:
+                break
+    assert handovers > 0, "free flight: the rocket was never handed over to pymunk"
+    reference.close()
+    hybrid.close()
+    check_snapshot(episodes, free_flight_altitude = FREE_FLIGHT_ALTITUDE)
+
+def check_restore_memory(episodes, cycles = 2000):
+    # restoring over and over, back to back and between steps into and out of contact with the
+    # ground, doesn't grow the process
+    lander = RocketLander(render_mode = None)
+    for seed in range(episodes):
+        observations, _ = lander.reset(seed = seed)
+        airborne = lander.get_state()
+        for step in range(8000):
+            observations, _, terminated, _, _ = lander.step(descend(observations))
+            if (observations[6] and observations[7]) or terminated:
+                break
+        if not (observations[6] and observations[7]):
+            continue
+        landed = lander.get_state()
+        def restores():
+            lander.set_state(landed)
+            lander.set_state(landed)
+            lander.step(0)
+            lander.set_state(airborne)
+            lander.step(0)
+            lander.set_state(landed)
+            # the contacts end, and are restored once the space has dropped their arbiters
+            for step in range(5):
+                lander.step(1)
+        for cycle in range(cycles//10):
+            restores()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for cycle in range(cycles):
+            restores()
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak
+        assert growth <= RESTORE_MEMORY_GROWTH, f"restore memory of seed {seed}: grew {growth} KB over {cycles} cycles of restores"
+        break
+    else:
+        raise AssertionError("restore memory: no seed landed on both legs")
+    lander.close()
+
+def run_checks(checks, episodes):
+    for check in checks:
+        match check:
+            case "reset":
+                check_reset(episodes)
+            case "snapshot":
+                for profile in RocketLander.SIMULATION_PROFILES:
+                    check_snapshot(episodes, simulation_profile = profile)
+            case "free_flight":
+                check_free_flight(episodes)
+            case "restore_memory":
+                check_restore_memory(episodes)
+        print(f"{check}: ok", file=sys.stderr)
+
+if __name__ == "__main__":
+    args = get_arguments()
+    run_checks(args.checks, args.episodes)
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import math
+import queue
+import argparse
+import statistics
+import multiprocessing as mp
+import numpy as np
+from rocket_lander import RocketLander
+
+# Evaluation runs a fixed list of seeds, seeds[i] = first_seed + i, sharded round robin over
+# a pool of worker processes. Every worker steps its envs in lockstep and asks the policy for
+# all their actions in one batch. Episodes are streamed back as they finish, but the summary
+# and the early stop only ever look at the longest run of finished episodes in seed order, so
+# the result depends on the seeds alone, never on how fast each worker happened to be.
+
+def evaluation_worker(model_path, seeds, envs_per_worker, deterministic, max_steps, env_kwargs, results, stop):
+    if model_path.endswith(".npz"):
+        # exported policies run on numpy alone, the worker never imports torch
+        from numpy_policy import NumpyPolicy
+        model = NumpyPolicy(model_path)
+    else:
+        import torch
+        from stable_baselines3 import PPO
+        # one thread per worker, the processes already use every CPU
+        torch.set_num_threads(1)
+        model = PPO.load(model_path, device = "cpu")
+    envs = [RocketLander(render_mode = None, **env_kwargs) for _ in range(envs_per_worker)]
+    observations = np.zeros((envs_per_worker,) + envs[0].observation_space.shape, dtype=np.float32)
+    obs_rows = [observations[slot] for slot in range(envs_per_worker)]
+    pending = iter(seeds)
+    episodes = [None]*envs_per_worker
+
+    def start_episode(slot):
+        seed = next(pending, None)
+        if seed is None:
+            episodes[slot] = None
+            return
+        obs_rows[slot][:], _ = envs[slot].reset(seed = seed)
+        episodes[slot] = {"seed": seed, "reward": 0., "steps": 0}
+
+    for slot in range(envs_per_worker):
+        start_episode(slot)
+    while not stop.is_set():
+        slots = [slot for slot in range(envs_per_worker) if episodes[slot] is not None]
+        if not slots:
+            break
+        actions, _ = model.predict(observations[slots], deterministic = deterministic)
+        for slot, action in zip(slots, actions.tolist()):
+            reward, terminated = envs[slot].step_into(action, obs_rows[slot])
+            episode = episodes[slot]
+            episode["reward"] += reward
+            episode["steps"] += 1
+            if terminated or episode["steps"] >= max_steps:
+                episode.update(envs[slot].episode_summary())
+                episode["truncated"] = not terminated
+                results.put(episode)
+                start_episode(slot)
+    for env in envs:
+        env.close()
+    results.put(None)
+
+
+class EvaluationStats:
+
+    # Running mean and variance (Welford) of the episodes finished so far, in seed order.
+    # Once the interval is narrower than target_width, with at least min_episodes, the stats
+    # are done and later episodes are left out.
+    def __init__(self, first_seed, confidence, target_width = None, min_episodes = 30):
+        self.next_seed = first_seed
+        self.z = statistics.NormalDist().inv_cdf((1 + confidence)/2)
+        self.target_width = target_width
+        self.min_episodes = min_episodes
+        self.done = False
+        self.waiting = {}
+        self.episodes = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.landed = 0
+        self.touchdown_velocities = []
+        self.thrust_time = 0.
+
+    def add(self, episode):
+        self.waiting[episode["seed"]] = episode
+        while not self.done and self.next_seed in self.waiting:
+            episode = self.waiting.pop(self.next_seed)
+            self.next_seed += 1
+            self.episodes += 1
+            delta = episode["reward"] - self.mean
+            self.mean += delta/self.episodes
+            self.m2 += delta*(episode["reward"] - self.mean)
+            self.landed += episode["outcome"] == "landed"
+            if episode["touchdown_velocity"] is not None:
+                self.touchdown_velocities.append(episode["touchdown_velocity"])
+            self.thrust_time += episode["thrust_time"]
+            if self.target_width is not None and self.episodes >= self.min_episodes and self.ci_width <= self.target_width:
+                self.done = True
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2/(self.episodes - 1)) if self.episodes > 1 else math.inf
+
+    @property
+    def ci_width(self):
+        return 2*self.z*self.std/math.sqrt(self.episodes) if self.episodes > 1 else math.inf
+
+    def summary(self):
+        return {
+            "episodes": self.episodes,
+            "mean_reward": self.mean,
+            "std_reward": self.std,
+            "ci_low": self.mean - self.ci_width/2,
+            "ci_high": self.mean + self.ci_width/2,
+            "landing_rate": self.landed/self.episodes if self.episodes else None,
+            "mean_touchdown_velocity": statistics.fmean(self.touchdown_velocities) if self.touchdown_velocities else None,
+            "mean_thrust_time": self.thrust_time/self.episodes if self.episodes else None,
+        }
+
+
+def evaluate(model_path, episodes = 1000, first_seed = 0, workers = None, envs_per_worker = 8, ci_width = None, confidence = 0.95,
+             min_episodes = 30, results_path = None, deterministic = True, max_steps = 5000, start_method = None, **env_kwargs):
+    # Evaluates up to `episodes` episodes, stopping early once the confidence interval of the
+    # mean reward is narrower than ci_width. Every finished episode is appended to
+    # results_path as one JSON line.
+    workers = workers or os.cpu_count()
+    seeds = list(range(first_seed, first_seed + episodes))
+    if start_method is None:
+        start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+    ctx = mp.get_context(start_method)
+    if start_method == "forkserver":
+        ctx.set_forkserver_preload(["rocket_lander"])
+    results = ctx.Queue()
+    stop = ctx.Event()
+    processes = []
+    for worker in range(min(workers, episodes)):
+        args = (model_path, seeds[worker::workers], envs_per_worker, deterministic, max_steps, env_kwargs, results, stop)
+        process = ctx.Process(target=evaluation_worker, args=args, daemon=True)
+        process.start()
+        processes.append(process)
+
+    stats = EvaluationStats(first_seed, confidence, ci_width, min_episodes)
+    results_file = open(results_path, "a") if results_path is not None else None
+    start = time.perf_counter()
+    running = len(processes)
+    while running > 0:
+        try:
+            episode = results.get(timeout = 1)
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError("evaluation workers died before finishing their episodes")
+            continue
+        if episode is None:
+            running -= 1
+            continue
+        if results_file is not None:
+            results_file.write(json.dumps(dict(episode, model = model_path)) + "\n")
+        stats.add(episode)
+        if stats.done:
+            stop.set()
+    for process in processes:
+        process.join()
+    if results_file is not None:
+        results_file.close()
+
+    return dict(stats.summary(), model = model_path, seconds = time.perf_counter() - start)
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", help="Model files (.zip, or .npz from numpy_policy.py) to evaluate, one after the other on the same seeds", type=str, nargs="+")
+    parser.add_argument("-e", "--episodes", help="Largest number of episodes evaluated per model", default=1000, type=int)
+    parser.add_argument("-s", "--first_seed", help="Seed of the first episode, episode i uses first_seed + i", default=0, type=int)
+    parser.add_argument("-w", "--workers", help="Number of worker processes, all CPUs when not given", default=None, type=int)
+    parser.add_argument("--envs_per_worker", help="Number of environments every worker steps in one inference batch", default=8, type=int)
+    parser.add_argument("-c", "--ci_width", help="Stop once the confidence interval of the mean reward is this narrow", default=None, type=float)
+    parser.add_argument("--confidence", help="Confidence level of the interval", default=0.95, type=float)
+    parser.add_argument("-o", "--output", help="JSON lines file every finished episode is appended to", default=None, type=str)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_arguments()
+    for model_path in args.models:
+        summary = evaluate(model_path, args.episodes, args.first_seed, args.workers, args.envs_per_worker, args.ci_width, args.confidence, results_path=args.output)
+        print(json.dumps(summary), flush=True)
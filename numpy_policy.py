@@ -0,0 +1,75 @@
+import argparse
+import numpy as np
+
+# A trained MlpPolicy flattened into an .npz file: the policy side of the mlp extractor
+# followed by the action head, stored as float32 (in, out) matrices so a batch of
+# observations runs through it as plain matrix products. Loading and running it needs
+# numpy only, no torch nor stable-baselines3.
+ACTIVATIONS = {
+    "Tanh": np.tanh,
+    "ReLU": lambda x: np.maximum(x, 0.),
+}
+
+def export(model_path, output_path, check_samples = 10000):
+    # Writes the policy of a saved PPO model to output_path and returns the number of random
+    # observations, out of check_samples, where the numpy and deterministic torch actions differ.
+    import torch
+    from stable_baselines3 import PPO
+    policy = PPO.load(model_path, device = "cpu").policy
+    layers = [module for module in policy.mlp_extractor.policy_net if isinstance(module, torch.nn.Linear)]
+    layers.append(policy.action_net)
+    arrays = {}
+    for i, layer in enumerate(layers):
+        arrays[f"weight_{i}"] = layer.weight.detach().numpy().T.astype(np.float32)
+        arrays[f"bias_{i}"] = layer.bias.detach().numpy().astype(np.float32)
+    np.savez(output_path, activation = policy.activation_fn.__name__, layers = len(layers), **arrays)
+
+    observations = np.stack([policy.observation_space.sample() for _ in range(check_samples)])
+    torch_actions, _ = policy.predict(observations, deterministic = True)
+    numpy_actions = NumpyPolicy(output_path).act(observations)
+    return int(np.count_nonzero(torch_actions != numpy_actions))
+
+
+class NumpyPolicy:
+
+    def __init__(self, path):
+        with np.load(path) as arrays:
+            self.activation = ACTIVATIONS[str(arrays["activation"])]
+            layers = int(arrays["layers"])
+            self.weights = [arrays[f"weight_{i}"] for i in range(layers)]
+            self.biases = [arrays[f"bias_{i}"] for i in range(layers)]
+        self.rng = np.random.default_rng()
+
+    def logits(self, observations):
+        x = np.asarray(observations, dtype=np.float32)
+        for weight, bias in zip(self.weights[:-1], self.biases[:-1]):
+            x = self.activation(x @ weight + bias)
+        return x @ self.weights[-1] + self.biases[-1]
+
+    def act(self, observations):
+        # deterministic actions for a (N, obs) batch, a single observation gives a plain int
+        actions = self.logits(observations).argmax(axis=-1)
+        return int(actions) if actions.ndim == 0 else actions
+
+    def predict(self, observations, deterministic = True):
+        # same call as a stable-baselines3 model, so it can stand in for one
+        if deterministic:
+            return self.act(observations), None
+        # sampled from the softmax of the logits with the Gumbel max trick
+        logits = self.logits(observations)
+        actions = (logits + self.rng.gumbel(size=logits.shape)).argmax(axis=-1)
+        return (int(actions) if actions.ndim == 0 else actions), None
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="Saved PPO model (.zip) to export", type=str)
+    parser.add_argument("-o", "--output", help="Output .npz file, the model name with .npz when not given", default=None, type=str)
+    parser.add_argument("-c", "--check_samples", help="Number of random observations the exported actions are checked on", default=10000, type=int)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_arguments()
+    output = args.output or args.model.removesuffix(".zip") + ".npz"
+    mismatches = export(args.model, output, args.check_samples)
+    print(f"exported {output}, {mismatches}/{args.check_samples} actions differ from torch")
@@ -1,10 +1,302 @@
 import gymnasium as gym
 import pymunk
-import pygame
+from pymunk._chipmunk import ffi, lib
 import numpy as np
 import math
+import time
 import random as rand
 
+# pygame is only imported once something actually needs to draw or poll events
+pygame = None
+
+def load_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as _pygame
+        pygame = _pygame
+    return pygame
+
+def track_contacts(space, collision_type, contacts, index):
+    # Keeps contacts[index] equal to the number of shapes currently touching shapes of the
+    # given collision type. pymunk only calls back when a contact begins or ends, so reading
+    # the counter costs nothing however long the shapes stay apart or together.
+    def begin(arbiter, space, data):
+        contacts[index] += 1
+        return True
+    def separate(arbiter, space, data):
+        contacts[index] -= 1
+    if hasattr(space, "on_collision"):
+        # pymunk 7, begin's return value is ignored and the contact is always processed
+        space.on_collision(collision_type, begin = begin, separate = separate)
+    else:
+        handler = space.add_wildcard_collision_handler(collision_type)
+        handler.begin = begin
+        handler.separate = separate
+
+# WARM STARTING
+# Chipmunk starts every step from the impulses the previous one ended with. pymunk keeps that
+# state to itself, snapshots reach it through the same Chipmunk calls and structs pymunk's own
+# Space pickling uses, so a restored lander continues exactly like the one it was taken from.
+# Offset, in 8 byte words, and size of the accumulated impulse in the 64 bit structs of the
+# joints that are warm started, damped springs start every step from scratch.
+JOINT_IMPULSES = {pymunk.constraints.PivotJoint: (25, 2), pymunk.constraints.RotaryLimitJoint: (17, 1)}
+# offsets in the body struct of its center of gravity, its velocity follows right after, and
+# of the first of the arbiters the body is threaded on
+BODY_CENTER = 8
+BODY_ARBITERS = 29
+# offsets in the space struct of the array of the arbiters the last step solved, which the next
+# one starts by marking as ongoing contacts, of the pool new arbiters are taken from and of the
+# blocks the space frees along with itself
+SPACE_ARBITERS = 20
+SPACE_POOLED_ARBITERS = 23
+SPACE_ALLOCATED_BUFFERS = 24
+# cached contacts: present, order of the shapes, Chipmunk state, age in steps, contact count,
+# then normal impulse, tangent impulse and the low and high 32 bits of the hash of each contact
+ARBITER_SIZE = 5 + 4*lib.CP_MAX_CONTACTS_PER_ARBITER
+
+def space_array(space, offset):
+    return ffi.cast("cpArray *", ffi.cast("void **", space._space)[offset])
+
+def check_layout():
+    # pymunk doesn't declare the body, joint and space structs, the offsets above are checked
+    # once against a probe world with known values and the module refuses to load if any is off
+    space = pymunk.Space()
+    space.gravity = 0, -10
+    ground = pymunk.Segment(space.static_body, (-10, 0), (10, 0), 0.5)
+    body = pymunk.Body()
+    box = pymunk.Poly.create_box(body, (1, 1))
+    box.mass = 1
+    body.position = 0, 0.9
+    arm = pymunk.Body(1, 1)
+    arm.position = 0, 3
+    pivot = pymunk.constraints.PivotJoint(body, arm, (0, 3))
+    limit = pymunk.constraints.RotaryLimitJoint(body, arm, 0, 0)
+    space.add(ground, body, box, arm, pivot, limit)
+    space.step(1/60)
+    [arbiter] = space._get_arbiters()
+    solved = space_array(space, SPACE_ARBITERS)
+    pooled = space_array(space, SPACE_POOLED_ARBITERS)
+    allocated = space_array(space, SPACE_ALLOCATED_BUFFERS)
+    # the step took the arbiter from the end of a block it just pooled, the one before it is next
+    block = ffi.cast("void *", arbiter - pooled.num)
+    layout = [
+        solved.num == 1 and solved.arr[0] == arbiter,
+        pooled.num > 0 and ffi.cast("cpArbiter *", pooled.arr[pooled.num-1]) + 1 == arbiter,
+        block in [allocated.arr[i] for i in range(allocated.num)],
+    ]
+    for probe in [body, space.static_body]:
+        layout.append(ffi.cast("cpArbiter **", probe._body)[BODY_ARBITERS] == arbiter)
+    words = ffi.cast("double *", body._body)
+    body.velocity = 0.75, -1.5
+    [words[BODY_CENTER], words[BODY_CENTER+1]] = [1.25, -2.5]
+    body.angle = 0.
+    layout.append(list(body.position) == [1.25, -2.5] and [words[BODY_CENTER+2], words[BODY_CENTER+3]] == [0.75, -1.5])
+    for constraint, [impulse, magnitude] in [(pivot, [[3., 4.], 5.]), (limit, [[-2.5], 2.5])]:
+        set_joint_impulse(constraint, impulse)
+        layout.append(get_joint_impulse(constraint) == impulse and constraint.impulse == magnitude)
+    if not all(layout):
+        raise RuntimeError(f"unexpected Chipmunk struct layout in pymunk {pymunk.version}, snapshots would corrupt the simulation")
+
+def get_center(body):
+    # pymunk moves bodies by their center of gravity, reading the position and writing it back
+    # can be a rounding off, the center itself is exact
+    words = ffi.cast("double *", body._body)
+    return [words[BODY_CENTER], words[BODY_CENTER+1]]
+
+def set_center(body, center, angle):
+    words = ffi.cast("double *", body._body)
+    [words[BODY_CENTER], words[BODY_CENTER+1]] = center
+    # setting the angle recomputes the transform pymunk derives the position from
+    body.angle = angle
+
+def get_joint_impulse(constraint):
+    [offset, size] = JOINT_IMPULSES[type(constraint)]
+    words = ffi.cast("double *", constraint._constraint)
+    return [words[offset+i] for i in range(size)]
+
+def set_joint_impulse(constraint, impulse):
+    [offset, size] = JOINT_IMPULSES[type(constraint)]
+    words = ffi.cast("double *", constraint._constraint)
+    for i in range(size):
+        words[offset+i] = impulse[i]
+
+def arbiter_thread(arbiter, body):
+    # the links of the arbiter in the list of arbiters the body is threaded on
+    return arbiter.thread_a if arbiter.body_a == body else arbiter.thread_b
+
+def thread_arbiter(arbiter):
+    # what the end of a step does to the arbiters it solved
+    for body in [arbiter.body_a, arbiter.body_b]:
+        head = ffi.cast("cpArbiter **", body) + BODY_ARBITERS
+        arbiter_thread(arbiter, body).next = head[0]
+        if head[0] != ffi.NULL:
+            arbiter_thread(head[0], body).prev = arbiter
+        head[0] = arbiter
+
+def unthread_arbiter(arbiter):
+    # what the start of the next step does to them
+    for body in [arbiter.body_a, arbiter.body_b]:
+        links = arbiter_thread(arbiter, body)
+        head = ffi.cast("cpArbiter **", body) + BODY_ARBITERS
+        if links.prev != ffi.NULL:
+            arbiter_thread(links.prev, body).next = links.next
+        elif head[0] == arbiter:
+            head[0] = links.next
+        if links.next != ffi.NULL:
+            arbiter_thread(links.next, body).prev = links.prev
+        links.prev = links.next = ffi.NULL
+
+def new_arbiter(space, a, b):
+    # a cached arbiter for shapes the space has none for, taken from the pool like a step takes
+    # one for shapes that start touching. An arbiter allocated when the pool is empty is handed
+    # to the space, which frees it with its own blocks, and joins the pool once it ends.
+    pooled = space_array(space, SPACE_POOLED_ARBITERS)
+    if pooled.num:
+        pooled.num -= 1
+        arbiter = lib.cpArbiterInit(ffi.cast("cpArbiter *", pooled.arr[pooled.num]), a._shape, b._shape)
+    else:
+        arbiter = lib.cpArbiterNew(a._shape, b._shape)
+        lib.cpArrayPush(space_array(space, SPACE_ALLOCATED_BUFFERS), arbiter)
+    lib.cpSpaceAddCachedArbiter(space._space, arbiter)
+    if hasattr(arbiter, "handlerAB"):
+        # pymunk 7 looks the handlers up under a hash Munk2D never stores them under, the
+        # restored arbiter would end without calling separate, so set them like a step does
+        handlers = {key: handler._handler for key, handler in space._handlers.items()}
+        [type_a, type_b] = [a.collision_type, b.collision_type]
+        for name, key in [("handlerAB", (type_a, type_b)), ("handlerBA", (type_b, type_a)), ("handlerA", (type_a, None)), ("handlerB", (type_b, None))]:
+            if key in handlers and (name != "handlerBA" or type_a != type_b):
+                setattr(arbiter, name, handlers[key])
+        arbiter.swapped = False
+    return arbiter
+
+def get_arbiters(space, pairs):
+    # the cached arbiters of the given shape pairs, ARBITER_SIZE values per pair
+    slots = {frozenset([a._shape, b._shape]): slot for slot, (a, b) in enumerate(pairs)}
+    values = [0.]*(len(pairs)*ARBITER_SIZE)
+    stamp = lib.cpSpaceGetTimestamp(space._space)
+    persistence = lib.cpSpaceGetCollisionPersistence(space._space)
+    for arbiter in space._get_arbiters():
+        slot = slots.get(frozenset([arbiter.a, arbiter.b]))
+        age = (stamp - arbiter.stamp) % 2**32
+        # an arbiter set_arbiters expired is dropped by the next step
+        if slot is None or age >= persistence:
+            continue
+        row = [1, arbiter.a != pairs[slot][0]._shape, arbiter.state, age, arbiter.count]
+        for contact in arbiter.contacts[0:arbiter.count]:
+            row += [contact.jnAcc, contact.jtAcc, contact.hash & 0xffffffff, contact.hash >> 32]
+        values[slot*ARBITER_SIZE:slot*ARBITER_SIZE+len(row)] = row
+    return values
+
+def set_arbiters(space, pairs, values, contacts):
+    # Puts back the cached arbiters saved by get_arbiters. The ones the space still caches are
+    # overwritten in place, keeping the order a collision gave their shapes, which is the one
+    # any lander built the same way gives them. Missing ones are added and the ones the snapshot
+    # doesn't have expire with the next step. The contacts are written to the caller's array,
+    # CP_MAX_CONTACTS_PER_ARBITER per pair, until the next collision moves them to the space's buffers.
+    stamp = lib.cpSpaceGetTimestamp(space._space)
+    persistence = lib.cpSpaceGetCollisionPersistence(space._space)
+    cached = {frozenset([arbiter.a, arbiter.b]): arbiter for arbiter in space._get_arbiters()}
+    arbiters = []
+    for slot, (a, b) in enumerate(pairs):
+        row = values[slot*ARBITER_SIZE:(slot+1)*ARBITER_SIZE]
+        arbiter = cached.get(frozenset([a._shape, b._shape]))
+        if arbiter is None and row[0]:
+            arbiter = new_arbiter(space, *([b, a] if row[1] else [a, b]))
+        arbiters.append(arbiter)
+    # the next step marks exactly the arbiters the snapshot's last step solved as ongoing contacts
+    restored = set(arbiter for arbiter in arbiters if arbiter is not None)
+    solved = space_array(space, SPACE_ARBITERS)
+    count = 0
+    for i in range(solved.num):
+        arbiter = ffi.cast("cpArbiter *", solved.arr[i])
+        if arbiter in restored:
+            unthread_arbiter(arbiter)
+        else:
+            solved.arr[count] = solved.arr[i]
+            count += 1
+    solved.num = count
+    for slot, arbiter in enumerate(arbiters):
+        if arbiter is None:
+            continue
+        row = values[slot*ARBITER_SIZE:(slot+1)*ARBITER_SIZE]
+        if not row[0]:
+            # an ended contact too old to warm start anything, the next step drops it
+            [arbiter.state, arbiter.stamp] = [lib.CP_ARBITER_STATE_CACHED, (stamp - persistence) % 2**32]
+            [arbiter.count, arbiter.contacts] = [0, ffi.NULL]
+            continue
+        arbiter.state = int(row[2])
+        arbiter.stamp = (stamp - int(row[3])) % 2**32
+        arbiter.count = int(row[4])
+        arbiter.contacts = contacts + slot*lib.CP_MAX_CONTACTS_PER_ARBITER
+        for i in range(arbiter.count):
+            [jn, jt, low, high] = row[5+4*i:9+4*i]
+            contact = arbiter.contacts[i]
+            [contact.jnAcc, contact.jtAcc, contact.hash] = [jn, jt, int(low) | int(high) << 32]
+        if not row[3] and row[2] not in [lib.CP_ARBITER_STATE_CACHED, lib.CP_ARBITER_STATE_IGNORE]:
+            lib.cpArrayPush(solved, arbiter)
+            thread_arbiter(arbiter)
+
+check_layout()
+
+
+class PhaseTimer:
+
+    # Cumulative and histogram timings of the phases of RocketLander.step. Histogram bucket i
+    # counts calls that took between 2**(i-1) and 2**i nanoseconds.
+    PHASES = ["step", "inputs", "collisions", "physics", "events", "observations", "reward", "render"]
+    HISTOGRAM_BINS = 40
+
+    def __init__(self):
+        self.calls = {phase: 0 for phase in self.PHASES}
+        self.totals = {phase: 0 for phase in self.PHASES}
+        self.histograms = {phase: [0]*self.HISTOGRAM_BINS for phase in self.PHASES}
+
+    def reset(self):
+        # zeroed in place, the timed wrappers hold on to these dicts and lists
+        for phase in self.PHASES:
+            self.calls[phase] = 0
+            self.totals[phase] = 0
+            self.histograms[phase][:] = [0]*self.HISTOGRAM_BINS
+
+    def timed(self, phase, function):
+        calls, totals, histogram = self.calls, self.totals, self.histograms[phase]
+        last_bin = self.HISTOGRAM_BINS-1
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter_ns()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter_ns() - start
+            calls[phase] += 1
+            totals[phase] += elapsed
+            histogram[min(elapsed.bit_length(), last_bin)] += 1
+            return result
+        return timed_function
+
+    def stats(self):
+        return {
+            phase: {
+                "calls": self.calls[phase],
+                "total_s": self.totals[phase]/1e9,
+                "mean_us": self.totals[phase]/self.calls[phase]/1e3 if self.calls[phase] else 0.,
+                "histogram": list(self.histograms[phase]),
+            }
+            for phase in self.PHASES
+        }
+
+    @staticmethod
+    def merge(stats_list):
+        # adds up the stats of several envs, e.g. every sub env of a vector env
+        merged = {}
+        for stats in stats_list:
+            for phase, phase_stats in stats.items():
+                if phase not in merged:
+                    merged[phase] = {"calls": 0, "total_s": 0., "histogram": [0]*len(phase_stats["histogram"])}
+                merged[phase]["calls"] += phase_stats["calls"]
+                merged[phase]["total_s"] += phase_stats["total_s"]
+                merged[phase]["histogram"] = [a + b for a, b in zip(merged[phase]["histogram"], phase_stats["histogram"])]
+        for phase_stats in merged.values():
+            phase_stats["mean_us"] = 1e6*phase_stats["total_s"]/phase_stats["calls"] if phase_stats["calls"] else 0.
+        return merged
+
 
 class Camera:
 
@@ -13,22 +305,44 @@ class Camera:
         self.resolution = resolution
         self.scale = scale
 
+def rotate(vertices, angles):
+    # rotates (..., V, 2) vertices by angles broadcasting against their leading dimensions
+    cos = np.cos(angles)[..., None]
+    sin = np.sin(angles)[..., None]
+    x = vertices[..., 0]
+    y = vertices[..., 1]
+    return np.stack([x*cos - y*sin, x*sin + y*cos], axis=-1)
+
+def project(camera, vertices, positions, angles):
+    # body space (..., V, 2) vertices of bodies at positions (..., 2) and angles (...) to pixels
+    points = rotate(vertices, angles) + np.asarray(positions)[..., None, :]
+    points -= [camera.position[0], camera.position[1]]
+    points *= camera.scale
+    points += [camera.resolution[0]/2, camera.resolution[1]/2]
+    return points
+
+def on_screen(camera, points):
+    # (..., V, 2) pixel polygons -> (...) mask of the ones whose bounding box overlaps the screen
+    low = points.min(axis=-2)
+    high = points.max(axis=-2)
+    return (
+        (high[..., 0] >= 0) & (low[..., 0] <= camera.resolution[0]) &
+        (high[..., 1] >= 0) & (low[..., 1] <= camera.resolution[1])
+    )
+
 class Shape:
 
     def __init__(self, vertices = [[-1,1],[1,1],[1,-1],[-1,-1]], color = (255, 255, 255)):
-        self.vertices = vertices
+        self.vertices = np.array(vertices, dtype=float)
         self.color = color
 
-
-    def __transform(self, camera, displacement, rotation, vertex):
-        [x, y] = vertex
-        [x, y] = [x*math.cos(rotation)-y*math.sin(rotation), x*math.sin(rotation)+y*math.cos(rotation)]
-        [x, y] = [x+displacement[0], y+displacement[1]]
-        [x, y] = [camera.scale*(x-camera.position[0])+camera.resolution[0]/2, camera.scale*(y-camera.position[1])+camera.resolution[1]/2]
-        return [x, y]
+    def transform(self, camera, displacement, rotation):
+        return project(camera, self.vertices, displacement, rotation)
 
     def draw(self, display, camera, displacement, rotation):
-        pygame.draw.polygon(display, self.color, [self.__transform(camera, displacement, rotation, vertex) for vertex in self.vertices])
+        points = self.transform(camera, displacement, rotation)
+        if on_screen(camera, points):
+            pygame.draw.polygon(display, self.color, points.tolist())
 
 
 class Circle(Shape):
@@ -39,12 +353,12 @@ class Circle(Shape):
         self.radius = radius
         self.color = color
         self.line_color = line_color
+        self.vertices = np.array([[0, 0], [0, -radius]], dtype=float)
 
     def draw(self, display, camera, displacement, rotation):
-        pygame.draw.circle(display, self.color, self._Shape__transform(camera, displacement, rotation, [0, 0]), self.radius*camera.scale)
-        pygame.draw.line(display, self.line_color,
-                self._Shape__transform(camera, displacement, rotation, [0, 0]), self._Shape__transform(camera, displacement, rotation,[0, -self.radius]),
-                width = self.DEBUG_LINE_WIDTH)
+        [center, tip] = self.transform(camera, displacement, rotation).tolist()
+        pygame.draw.circle(display, self.color, center, self.radius*camera.scale)
+        pygame.draw.line(display, self.line_color, center, tip, width = self.DEBUG_LINE_WIDTH)
 
 
 class Rocket(pymunk.Body):
@@ -57,83 +371,82 @@ class Rocket(pymunk.Body):
     LEGS_ANGLE = math.pi/4 #Rad
     MAX_THRUSTER_ANGLE = math.pi/18 #Rad
     MAX_THRUSTER_FORCE = 845000 #Newtons
+    # simulation attributes
+    COLLISION_TYPES = [1, 2, 3] #body, left leg and right leg
 
     # visual attributes
     ATTITUDE_INDICATOR_SCALE = 10 #Pixels
 
-    def __bell_transform(self, vertex):
-        angle = self.MAX_THRUSTER_ANGLE*self.thruster_vector
-        [x, y] = vertex
-        [x, y] = [x*math.cos(angle)-y*math.sin(angle), x*math.sin(angle) + y*math.cos(angle)]
-        [x, y] = [x, y+self.HEIGHT/2]
-        return [x, y]
-
-    def __exhaust_transform(self, vertex):
-        [x, y] = vertex
-        [x, y] = [self.thruster_power*x, self.thruster_power*y]
-        [x, y] = self.__bell_transform([x, y])
-        return [x, y]
-
-    def __attitude_indicator_transform(self, vertex, scale):
-        indicator_size = self.ATTITUDE_INDICATOR_SCALE
-        [x, y] = vertex
-        [x, y] = [indicator_size*x/scale, indicator_size*y/scale]
-        return [x, y]
-
-    def update_collisions(self):
-        _bodies = [self.body_poly, self.leg_poly_l, self.leg_poly_r]
-        def shape_colliding(arbiter, shape, collisions):
-            if shape in arbiter.shapes:
-                collisions[shape] = True
-        collisions = {body: False for body in _bodies}
-        self.each_arbiter(shape_colliding, _bodies[0], collisions)
-        self.leg_body_l.each_arbiter(shape_colliding, _bodies[1], collisions)
-        self.leg_body_r.each_arbiter(shape_colliding, _bodies[2], collisions)
-
-        self.collisions = [collisions[body] for body in _bodies]
+    # VERTICES
+    # static elements
+    BOOSTER_VERTICES = [[-WIDTH/2,-HEIGHT/2],[WIDTH/2,-HEIGHT/2],[WIDTH/2,HEIGHT/2],[-WIDTH/2,HEIGHT/2]]
+    LEG_VERTICES = [[-WIDTH/2/5, 0],[WIDTH/2/5, 0],[WIDTH/2/10, WIDTH],[-WIDTH/2/10, WIDTH]]
+    # dynamic elements
+    BELL_VERTICES = [[-WIDTH/2/3,-WIDTH/2],[WIDTH/2/3,-WIDTH/2],[WIDTH/3,WIDTH/2],[-WIDTH/3,WIDTH/2]]
+    EXHAUST_VERTICES = [[0,-WIDTH/2/2],[WIDTH/2/2,WIDTH/2],[0,4*(WIDTH/2)],[-WIDTH/2/2,WIDTH/2]]
+    # the last vertex is repeated so every part has four and all of them fit in a single array
+    ATTITUDE_INDICATOR_VERTICES = [[0,-1],[1,1],[-1,1],[-1,1]]
+
+    # VISUAL REPRESENTATION
+    # parts in drawing order: attitude indicator, exhaust, bell, booster, left leg and right leg
+    PART_COLORS = [(255, 50, 50), (255, 255, 50), (50, 50, 50), (255, 255, 255), (50, 50, 50), (50, 50, 50)]
+    # booster x, y, angle, left leg x, y, angle, right leg x, y, angle, thruster vector and power
+    POSE_SIZE = 11
+
+    def update_collisions(self, accumulate = False):
+        # the contact counters are kept current by the collision handlers
+        if self.restored_contacts is None:
+            [body, leg_l, leg_r] = self.contacts
+        else:
+            # first read after a restore, the handlers only see those contacts again in the next space step
+            [body, leg_l, leg_r], self.restored_contacts = self.restored_contacts, None
+        if accumulate:
+            [c_body, c_leg_l, c_leg_r] = self.collisions
+            self.collisions = [c_body or body > 0, c_leg_l or leg_l > 0, c_leg_r or leg_r > 0]
+        else:
+            self.collisions = [body > 0, leg_l > 0, leg_r > 0]
+
+    def contact_counts(self):
+        # contacts as the next update_collisions will see them
+        if self.restored_contacts is not None:
+            return list(self.restored_contacts)
+        return list(self.contacts)
 
     def __init__(self, space):
         # RUNTIME VARIABLES
         self.thruster_vector = 0. #[-1 1]
         self.thruster_power = 0. #[0 1]
         self.collisions = [False, False, False]
-
-        # VERTICES
-        hwidth = self.WIDTH/2
-        hheight = self.HEIGHT/2
-        # static elements
-        booster_vertices = [[-hwidth,-hheight],[hwidth,-hheight],[hwidth,hheight],[-hwidth,hheight]]
-        leg_vertices = [[-hwidth/5, 0],[hwidth/5, 0],[hwidth/10, self.WIDTH],[-hwidth/10, self.WIDTH]]
-        # dynamic elements
-        self.bell_vertices = [[-hwidth/3,-hwidth],[hwidth/3,-hwidth],[self.WIDTH/3,hwidth],[-self.WIDTH/3,hwidth]]
-        self.exhaust_vertices = [[0,-hwidth/2],[hwidth/2,hwidth],[0,4*hwidth],[-hwidth/2,hwidth]]
-        self.attitude_indicator_vertices = [[0,-1],[1,1],[-1,1]]
-
-        # VISUAL REPRESENTATION
-        self.booster = Shape(booster_vertices)
-        self.leg_l = Shape(leg_vertices, (50, 50, 50))
-        self.leg_r = Shape(leg_vertices, (50, 50, 50))
-        self.bell = Shape([self.__bell_transform(vertex) for vertex in self.bell_vertices], (50, 50, 50))
-        self.exhaust = Shape([self.__exhaust_transform(vertex) for vertex in self.exhaust_vertices], (255, 255, 50))
-        self.attitude_indicator = Shape([self.__attitude_indicator_transform(vertex, 10) for vertex in self.attitude_indicator_vertices], (255, 50, 50))
+        self.contacts = [0, 0, 0]
+        self.restored_contacts = None
 
         # PYSICAL REPRESENTATION
         super().__init__()
         self.leg_body_l = pymunk.Body()
         self.leg_body_r = pymunk.Body()
-
-        self.position = [0,-50]
-        self.leg_body_l.position = self.position + [-hwidth, hheight]
-        self.leg_body_r.position = self.position + [hwidth, hheight]
-        self.body_poly = pymunk.Poly(self, self.booster.vertices)
-        self.leg_poly_l = pymunk.Poly(self.leg_body_l, leg_vertices)
-        self.leg_poly_r = pymunk.Poly(self.leg_body_r, self.leg_r.vertices)
+        self.body_poly = pymunk.Poly(self, self.BOOSTER_VERTICES)
+        self.leg_poly_l = pymunk.Poly(self.leg_body_l, self.LEG_VERTICES)
+        self.leg_poly_r = pymunk.Poly(self.leg_body_r, self.LEG_VERTICES)
         self.body_poly.mass = (1-0.16)*self.EMPTY_MASS
         self.leg_poly_l.mass = 0.08*self.EMPTY_MASS
         self.leg_poly_r.mass = 0.08*self.EMPTY_MASS
         self.body_poly.friction = 0.6
         self.leg_poly_l.friction = 0.6
         self.leg_poly_r.friction = 0.6
+        for index, poly in enumerate([self.body_poly, self.leg_poly_l, self.leg_poly_r]):
+            poly.collision_type = self.COLLISION_TYPES[index]
+            track_contacts(space, poly.collision_type, self.contacts, index)
+
+        self.__assemble(space)
+        self.shape_id = lib.cpShapeGetHashID(self.body_poly._shape)
+
+    def __assemble(self, space):
+        hwidth = self.WIDTH/2
+        hheight = self.HEIGHT/2
+
+        self.position = [0,-50]
+        self.leg_body_l.position = self.position + [-hwidth, hheight]
+        self.leg_body_r.position = self.position + [hwidth, hheight]
 
         # landing leg constraints
         pivot_leg_l = pymunk.constraints.PivotJoint(self, self.leg_body_l, [-hwidth, hheight], [0, 0])
@@ -144,10 +457,39 @@ class Rocket(pymunk.Body):
         rotary_spring_leg_r =  pymunk.constraints.DampedRotarySpring(self, self.leg_body_r, self.LEGS_ANGLE, 5000000, 50000)
         rotary_limit_leg_l = pymunk.constraints.RotaryLimitJoint(self, self.leg_body_l, self.LEGS_ANGLE-math.pi/36, self.LEGS_ANGLE+math.pi/36)
         rotary_limit_leg_r = pymunk.constraints.RotaryLimitJoint(self, self.leg_body_r, -self.LEGS_ANGLE-math.pi/36, -self.LEGS_ANGLE+math.pi/36)
+        self.leg_constraints = [pivot_leg_l, pivot_leg_r, rotary_spring_leg_l, rotary_spring_leg_r, rotary_limit_leg_l, rotary_limit_leg_r]
 
         space.add(self, self.body_poly)
         space.add(self.leg_body_l, self.leg_poly_l, self.leg_body_r, self.leg_poly_r)
-        space.add(pivot_leg_l, pivot_leg_r, rotary_spring_leg_l, rotary_spring_leg_r, rotary_limit_leg_l, rotary_limit_leg_r)
+        space.add(*self.leg_constraints)
+
+    def reset(self):
+        # Taking the assembly out of the space drops its cached arbiters and, together with
+        # the freshly built constraints, every bit of warm starting solver state, so the
+        # next episode runs exactly as it would in a newly built world. Chipmunk numbers the
+        # shapes as they are added and hashes contacts with those numbers, the booster's shape
+        # gets its number back and the legs the next two, the same in every lander.
+        space = self.space
+        space.remove(*self.leg_constraints)
+        space.remove(self.body_poly, self.leg_poly_l, self.leg_poly_r)
+        space.remove(self, self.leg_body_l, self.leg_body_r)
+        for body in [self, self.leg_body_l, self.leg_body_r]:
+            body.angle = 0.
+            body.velocity = 0, 0
+            body.angular_velocity = 0.
+            body.force = 0, 0
+            body.torque = 0.
+
+        self.thruster_vector = 0.
+        self.thruster_power = 0.
+        self.collisions = [False, False, False]
+        # removing the shapes already ran the separate callbacks, this just makes it explicit
+        self.contacts[:] = [0, 0, 0]
+        self.restored_contacts = None
+        counter = lib.cpSpaceGetShapeIDCounter(space._space)
+        lib.cpSpaceSetShapeIDCounter(space._space, self.shape_id)
+        self.__assemble(space)
+        lib.cpSpaceSetShapeIDCounter(space._space, counter)
 
     def thrust(self):
         angle = self.MAX_THRUSTER_ANGLE*self.thruster_vector
@@ -155,17 +497,48 @@ class Rocket(pymunk.Body):
         [x, y] = [x*math.cos(angle)-y*math.sin(angle), x*math.sin(angle) + y*math.cos(angle)]
         self.apply_force_at_local_point([x, y], [0, self.HEIGHT/2])
 
-    def draw(self, display, camera):
-        self.attitude_indicator.vertices = [self.__attitude_indicator_transform(vertex, camera.scale) for vertex in self.attitude_indicator_vertices]
-        self.exhaust.vertices = [self.__exhaust_transform(vertex) for vertex in self.exhaust_vertices]
-        self.bell.vertices = [self.__bell_transform(vertex) for vertex in self.bell_vertices]
+    def pose(self):
+        return [
+            *self.position, self.angle,
+            *self.leg_body_l.position, self.leg_body_l.angle,
+            *self.leg_body_r.position, self.leg_body_r.angle,
+            self.thruster_vector, self.thruster_power,
+        ]
 
-        self.attitude_indicator.draw(display, camera, self.position, self.angle)
-        self.exhaust.draw(display, camera, self.position, self.angle)
-        self.bell.draw(display, camera, self.position, self.angle)
-        self.booster.draw(display, camera, self.position, self.angle)
-        self.leg_l.draw(display, camera, self.leg_body_l.position,  self.leg_body_l.angle)
-        self.leg_r.draw(display, camera,  self.leg_body_r.position,  self.leg_body_r.angle)
+    def draw(self, display, camera):
+        self.draw_poses(display, camera, [self.pose()])
+
+    @classmethod
+    def draw_poses(cls, display, camera, poses):
+        # Every part of every rocket goes through one batched projection, parts whose
+        # bounding box is off screen are never handed to pygame.
+        poses = np.asarray(poses, dtype=float).reshape(-1, cls.POSE_SIZE)
+        count = len(poses)
+        gimbal = cls.MAX_THRUSTER_ANGLE*poses[:, 9]
+        power = poses[:, 10, None, None]
+
+        vertices = np.empty((count, 6, 4, 2))
+        vertices[:, 0] = np.array(cls.ATTITUDE_INDICATOR_VERTICES)*cls.ATTITUDE_INDICATOR_SCALE/camera.scale
+        vertices[:, 1] = rotate(power*cls.EXHAUST_VERTICES, gimbal) + [0, cls.HEIGHT/2]
+        vertices[:, 2] = rotate(np.array(cls.BELL_VERTICES), gimbal) + [0, cls.HEIGHT/2]
+        vertices[:, 3] = cls.BOOSTER_VERTICES
+        vertices[:, 4] = cls.LEG_VERTICES
+        vertices[:, 5] = cls.LEG_VERTICES
+        positions = np.empty((count, 6, 2))
+        angles = np.empty((count, 6))
+        positions[:, :4] = poses[:, None, 0:2]
+        angles[:, :4] = poses[:, 2, None]
+        positions[:, 4] = poses[:, 3:5]
+        angles[:, 4] = poses[:, 5]
+        positions[:, 5] = poses[:, 6:8]
+        angles[:, 5] = poses[:, 8]
+
+        points = project(camera, vertices, positions, angles)
+        visible = on_screen(camera, points)
+        for rocket_points, rocket_visible in zip(points.tolist(), visible.tolist()):
+            for color, part_points, part_visible in zip(cls.PART_COLORS, rocket_points, rocket_visible):
+                if part_visible:
+                    pygame.draw.polygon(display, color, part_points)
 
 class Planet(pymunk.Body):
     PAD_WIDTH = 86 #m
@@ -173,6 +546,7 @@ class Planet(pymunk.Body):
     TERRAIN_WIDTH = 100000 #m
     TERRAIN_HEIGHT = 100000 #m
     #DIAMETER = 12742000 #m
+    TERRAIN_COLLISION_TYPE = 4
 
     def __init__(self, space):
         hwidth = self.PAD_WIDTH/2
@@ -186,37 +560,150 @@ class Planet(pymunk.Body):
         # PYSICAL REPRESENTATION
         super().__init__(body_type= pymunk.Body.STATIC)
         self.position = [0,-hheight]
-        pad_poly = pymunk.Poly(self,pad_vertices)
+        self.pad_poly = pymunk.Poly(self,pad_vertices)
         self.terrain_poly = pymunk.Poly(self, terrain_vertices)
-        pad_poly.friction = 0.6
+        self.pad_poly.friction = 0.6
         self.terrain_poly.friction = 0.6
-        space.add(self, pad_poly, self.terrain_poly)
+        self.terrain_poly.collision_type = self.TERRAIN_COLLISION_TYPE
+        self.collisions = [False]
+        self.contacts = [0]
+        self.restored_contacts = None
+        track_contacts(space, self.TERRAIN_COLLISION_TYPE, self.contacts, 0)
+        space.add(self, self.pad_poly, self.terrain_poly)
 
         # VISUAL REPRESENTATION
         self.pad = Shape(pad_vertices)
         self.terrain = Shape(terrain_vertices, (25, 25, 25))
         #self.terrain = Circle(self.DIAMETER/2, color = (100, 150, 255), line_color = (255, 0, 0))
 
-    def update_collisions(self):
-        bodies_to_check = [self.terrain_poly]
-        def shape_colliding(arbiter, collisions):
-            for shape in collisions.keys():
-                if shape in arbiter.shapes:
-                    collisions[shape] = True
-        collisions = {body: False for body in bodies_to_check}
-        self.each_arbiter(shape_colliding, collisions)
+    def update_collisions(self, accumulate = False):
+        # the contact counter is kept current by the collision handler
+        if self.restored_contacts is None:
+            [terrain] = self.contacts
+        else:
+            [terrain], self.restored_contacts = self.restored_contacts, None
+        if accumulate:
+            self.collisions = [self.collisions[0] or terrain > 0]
+        else:
+            self.collisions = [terrain > 0]
 
-        self.collisions = [collisions[body] for body in bodies_to_check]
+    def contact_counts(self):
+        # contacts as the next update_collisions will see them
+        if self.restored_contacts is not None:
+            return list(self.restored_contacts)
+        return list(self.contacts)
 
     def draw(self, display, camera):
         self.pad.draw(display, camera, self.position, self.angle)
         self.terrain.draw(display, camera, self.position, self.angle)
         #self.terrain.draw(display, camera, [self.position[0], self.position[1]+self.PAD_HEIGHT/2], self.angle)
 
+class FreeFlight:
+
+    # Flies the rocket as a single rigid body while it is far above the ground. Without
+    # contacts, and with the legs held at their rest angle by stiff springs, the assembly
+    # moves almost exactly like one body, so gravity and thrust are integrated here with the
+    # same semi-implicit Euler step pymunk uses, skipping the constraint solver and collision
+    # detection. Plain float math is used, for a single rocket it beats any numpy call. The
+    # pymunk bodies are left alone while it flies, place writes all three once something
+    # reads them: the handover to pymunk, snapshots, poses and drawing.
+
+    def __init__(self, rocket, gravity, ground):
+        self.rocket = rocket
+        [self.gx, self.gy] = gravity
+        self.ground = ground #world y of the highest ground point
+        hwidth = rocket.WIDTH/2
+        hheight = rocket.HEIGHT/2
+        # body, origin and center of gravity in the booster frame, angle relative to the booster
+        parts = [(rocket, [0., 0.], 0., rocket.BOOSTER_VERTICES)]
+        for leg, pivot, angle in [(rocket.leg_body_l, [-hwidth, hheight], rocket.LEGS_ANGLE), (rocket.leg_body_r, [hwidth, hheight], -rocket.LEGS_ANGLE)]:
+            parts.append((leg, pivot, angle, rocket.LEG_VERTICES))
+        self.mass = sum(body.mass for body, _, _, _ in parts)
+        cogs = [self.__to_booster(origin, angle, body.center_of_gravity) for body, origin, angle, _ in parts]
+        [cx, cy] = [sum(body.mass*cog[i] for (body, _, _, _), cog in zip(parts, cogs))/self.mass for i in range(2)]
+        self.moment = sum(body.moment + body.mass*((x-cx)**2 + (y-cy)**2) for (body, _, _, _), [x, y] in zip(parts, cogs))
+        # offsets from the common center of gravity, still in the booster frame
+        self.parts = [(body, [ox-cx, oy-cy], angle, [x-cx, y-cy]) for (body, [ox, oy], angle, _), [x, y] in zip(parts, cogs)]
+        self.thrust_point = [-cx, hheight-cy]
+        # farthest vertex from the center of gravity, bounds the rocket however it is turned
+        self.radius = max(
+            math.hypot(vx-cx, vy-cy)
+            for _, origin, angle, vertices in parts
+            for vx, vy in [self.__to_booster(origin, angle, vertex) for vertex in vertices]
+        )
+        [self.x, self.y, self.vx, self.vy, self.angle, self.angular_velocity] = [0.]*6
+
+    @staticmethod
+    def __to_booster(origin, angle, point):
+        [px, py] = point
+        return [origin[0] + px*math.cos(angle) - py*math.sin(angle), origin[1] + px*math.sin(angle) + py*math.cos(angle)]
+
+    def capture(self):
+        # takes over the current state of the assembly, momentum is kept, leg flex is dropped
+        rocket = self.rocket
+        self.angle = rocket.angle
+        self.angular_velocity = rocket.angular_velocity
+        [_, [ox, oy], _, _] = self.parts[0]
+        [x, y] = rocket.position
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        self.x = x - (ox*cos - oy*sin)
+        self.y = y - (ox*sin + oy*cos)
+        self.vx = sum(body.mass*body.velocity.x for body, _, _, _ in self.parts)/self.mass
+        self.vy = sum(body.mass*body.velocity.y for body, _, _, _ in self.parts)/self.mass
+
+    def clearance(self):
+        # distance left between the ground and the lowest point the rocket could reach by turning
+        return self.ground - self.y - self.radius
+
+    def step(self, dt):
+        rocket = self.rocket
+        # same force and application point as Rocket.thrust
+        gimbal = rocket.MAX_THRUSTER_ANGLE*rocket.thruster_vector
+        force = -rocket.MAX_THRUSTER_FORCE*rocket.thruster_power
+        [fx, fy] = [-force*math.sin(gimbal), force*math.cos(gimbal)]
+        [tx, ty] = self.thrust_point
+        torque = tx*fy - ty*fx
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        # velocities first, positions with the new velocities, like cpBodyUpdateVelocity/Position
+        self.vx += (self.gx + (fx*cos - fy*sin)/self.mass)*dt
+        self.vy += (self.gy + (fx*sin + fy*cos)/self.mass)*dt
+        self.angular_velocity += torque/self.moment*dt
+        self.x += self.vx*dt
+        self.y += self.vy*dt
+        self.angle += self.angular_velocity*dt
+
+    def booster(self):
+        # position of the booster's origin and velocity of its center of gravity, as the
+        # booster body would report them once placed
+        [_, [ox, oy], _, [gx, gy]] = self.parts[0]
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        w = self.angular_velocity
+        position = [self.x + ox*cos - oy*sin, self.y + ox*sin + oy*cos]
+        velocity = [self.vx - w*(gx*sin + gy*cos), self.vy + w*(gx*cos - gy*sin)]
+        return position, velocity
+
+    def place(self):
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        w = self.angular_velocity
+        for body, _, angle, [gx, gy] in self.parts:
+            # by the center of gravity, a position set before the angle would be turned about
+            # the old one and misplace the legs, whose center of gravity is off their origin
+            set_center(body, [self.x + gx*cos - gy*sin, self.y + gx*sin + gy*cos], self.angle + angle)
+            # velocity of the body's center of gravity on the spinning rigid body
+            body.velocity = self.vx - w*(gx*sin + gy*cos), self.vy + w*(gx*cos - gy*sin)
+            body.angular_velocity = w
+
+    def get_state(self):
+        return [self.x, self.y, self.vx, self.vy, self.angle, self.angular_velocity]
+
+    def set_state(self, values):
+        [self.x, self.y, self.vx, self.vy, self.angle, self.angular_velocity] = values
+
 class RocketLander(gym.Env):
 
     # PARAMETERS
-    LANDER_INSTANCES = []
+    # modes that never open a window nor poll events, rgb_array draws offscreen
+    HEADLESS_MODES = [None, "headless", "rgb_array"]
     # VISUAL ATTRIBUTES
     BACKGROUND_COLOR = (100, 100, 150)
     WINDOW_RESOLUTION = [1000, 700]
@@ -225,7 +712,38 @@ class RocketLander(gym.Env):
     RENDER_TOGGLE = True
     # SIMULATION SETTINGS
     FPS = 60
+    metadata = {"render_modes": ["human", "fast", "rgb_array"], "render_fps": FPS}
     COMMITMENT_TIME = 5 #amount of seconds after a landing is considered valid
+    OUTCOMES = [None, "landed", "crashed", "out_of_bounds", "hard_landing"] #as numbered in snapshots
+    # Solver settings, None keeps the pymunk default. "accurate" is the plain pymunk.Space
+    # every earlier version used, the others trade accuracy for speed, run the profiles
+    # benchmark to see what that does to landing outcomes. With only the rocket's shapes and
+    # joints to solve, the solver settings save little, most of the speed comes from flying
+    # the rocket as a free body while it is high up, see FreeFlight.
+    SIMULATION_PROFILES = {
+        "accurate": {
+            "iterations": None,
+            "collision_slop": None,
+            "collision_bias": None,
+            "free_flight_altitude": None, #in m, unless the lander is given one
+            "timestep_scale": 1, #frames last timestep_scale*2/(3*FPS) seconds
+        },
+        "training": {
+            "iterations": 6,
+            "collision_slop": None,
+            # fewer iterations, overlaps pushed apart a little faster than the 10% per 1/60 s default
+            "collision_bias": pow(1-0.15, 60),
+            "free_flight_altitude": 50,
+            "timestep_scale": 1,
+        },
+        "fast": {
+            "iterations": 4,
+            "collision_slop": 0.2,
+            "collision_bias": pow(1-0.2, 60),
+            "free_flight_altitude": 20,
+            "timestep_scale": 2,
+        },
+    }
 
     # USER INPUTS
     in_left = False
@@ -264,26 +782,27 @@ class RocketLander(gym.Env):
 
         return action_space, observation_space
 
-    def __get_observations(self):
-        t_pos = -self.rocket.position - [0,self.rocket.HEIGHT/2]
-        r_vel = self.rocket.velocity
-        observations = [
-            t_pos[0]/500, t_pos[1]/500,
-            r_vel[0]/100, r_vel[1]/100,
-            self.rocket.angle,
-            self.rocket.angular_velocity,
-            int(self.rocket.collisions[1]), int(self.rocket.collisions[2])
-        ]
-
-        return observations
-
-    def __get_reward(self, delta_time):
+    def __get_observations(self, observations, position, velocity, angle, angular_velocity):
+        # filled element by element so no intermediate list or array is ever built
+        [x, y] = position
+        [vx, vy] = velocity
+        observations[0] = -x/500
+        observations[1] = (-y-self.rocket.HEIGHT/2)/500
+        observations[2] = vx/100
+        observations[3] = vy/100
+        observations[4] = angle
+        observations[5] = angular_velocity
+        observations[6] = self.rocket.collisions[1]
+        observations[7] = self.rocket.collisions[2]
+
+    def __get_reward(self, position):
         reward = 0
-        t_pos = -self.rocket.position - [0,self.rocket.HEIGHT/2]
-        r_vel = self.rocket.velocity
+        # plain float math, numpy calls on python scalars are several times slower
+        tx = -position[0]
+        ty = -position[1]-self.rocket.HEIGHT/2
         shaping = (
-            - 500 * np.sqrt(t_pos[0]/500 * t_pos[0]/500 + t_pos[1]/500 * t_pos[1]/500)
-            #- 1000 * np.sqrt(r_vel[0] * r_vel[0] + r_vel[1] * r_vel[1])
+            - 500 * math.sqrt(tx/500 * tx/500 + ty/500 * ty/500)
+            #- 1000 * math.sqrt(r_vel[0] * r_vel[0] + r_vel[1] * r_vel[1])
             #- 100 * abs(obs[4])
             + 100 * self.rocket.collisions[1]
             + 100 * self.rocket.collisions[2]
@@ -294,83 +813,392 @@ class RocketLander(gym.Env):
 
         #reward -= self.rocket.thruster_power * 100
 
+        # crash and landing rewards collected frame by frame in handle_logic
+        for term in self.reward_terms:
+            reward += term
+
+        return reward
+
+    def __get_events(self, delta_time, position, velocity):
+        # Evaluated after every frame, so contact timing and crashes stay exact
+        # even when several frames run under a single agent step.
         terminated = False
-        velocity = np.sqrt(r_vel[0]*r_vel[0] + r_vel[1]*r_vel[1])
-        if (
-            self.rocket.collisions[0] or self.planet.collisions[0] or
-            ((self.rocket.collisions[1] or self.rocket.collisions[2]) and velocity > 5) or
-            abs(t_pos[0]) > 500 or abs(t_pos[1]) > 500
-        ):
+        [x, y] = position
+        [vx, vy] = velocity
+        velocity = math.sqrt(vx*vx + vy*vy)
+        self.thrust_time += self.rocket.thruster_power*delta_time
+        if self.touchdown_velocity is None and (self.rocket.collisions[1] or self.rocket.collisions[2]):
+            self.touchdown_velocity = velocity
+        crashed = self.rocket.collisions[0] or self.planet.collisions[0]
+        hard_landing = (self.rocket.collisions[1] or self.rocket.collisions[2]) and velocity > 5
+        out_of_bounds = abs(x) > 500 or abs(y+self.rocket.HEIGHT/2) > 500
+        if crashed or hard_landing or out_of_bounds:
             terminated = True
             #print("womp womp")
-            reward += -velocity
+            self.outcome = "crashed" if crashed else "hard_landing" if hard_landing else "out_of_bounds"
+            self.reward_terms.append(-velocity)
         if self.rocket.collisions[1] and self.rocket.collisions[2] and velocity < 5:
             if self.contact_time > self.COMMITMENT_TIME:
                 terminated = True
-                reward += +1000
+                if self.outcome is None:
+                    self.outcome = "landed"
+                self.reward_terms.append(+1000)
                 #print("yipee")
             else:
                 self.contact_time += delta_time
-                reward += +100-velocity
+                self.reward_terms.append(+100-velocity)
         else:
             self.contact_time = 0.
 
-        return reward, terminated
+        return terminated
 
-    def __init_landing_scenario(self, seed):
-        rand.seed(seed)
+    def __build_landing_scenario(self):
         # SIMULATION ELEMENTS
-        self.contact_time = 0.
-        self.prev_shaping = None
+        settings = self.SIMULATION_PROFILES[self.simulation_profile]
         self.space = pymunk.Space()
         self.space.gravity = [0,9.81]
+        for name in ["iterations", "collision_slop", "collision_bias"]:
+            if settings[name] is not None:
+                setattr(self.space, name, settings[name])
         self.planet = Planet(self.space)
         self.rocket = Rocket(self.space)
-        self.rocket.position = [rand.uniform(-100., 100.), rand.uniform(-200., -100.)]
-        self.rocket.leg_body_l.position = self.rocket.position + [-self.rocket.WIDTH/2, self.rocket.HEIGHT/2]
-        self.rocket.leg_body_r.position = self.rocket.position + [self.rocket.WIDTH/2, self.rocket.HEIGHT/2]
+        # shape pairs whose cached contacts snapshots keep, every rocket part against the pad and the terrain
+        self.contact_pairs = [
+            (part, ground)
+            for part in [self.rocket.body_poly, self.rocket.leg_poly_l, self.rocket.leg_poly_r]
+            for ground in [self.planet.pad_poly, self.planet.terrain_poly]
+        ]
+        # where restored arbiters keep their contacts until they collide again
+        self.restored_arbiter_contacts = ffi.new("struct cpContact[]", len(self.contact_pairs)*lib.CP_MAX_CONTACTS_PER_ARBITER)
         # GYM ELEMENTS
         self.action_space, self.observation_space = self.__get_spaces()
+        self.observations = np.zeros(self.observation_space.shape, dtype=np.float32)
+        self.reward_terms = []
 
-    def __init__(self, render_mode = 'fast', seed = rand.random()):
+    def __init_landing_scenario(self, seed):
+        rand.seed(seed)
+        # the static world is built once, only the rocket is put back in place
+        self.contact_time = 0.
+        self.prev_shaping = None
+        # episode outcome, filled in by __get_events
+        self.outcome = None
+        self.touchdown_velocity = None
+        self.thrust_time = 0.
+        self.rocket.reset()
+        self.planet.restored_contacts = None
+        self.rocket.position = [rand.uniform(-100., 100.), rand.uniform(-200., -100.)]
+        self.rocket.leg_body_l.position = self.rocket.position + [-self.rocket.WIDTH/2, self.rocket.HEIGHT/2]
+        self.rocket.leg_body_r.position = self.rocket.position + [self.rocket.WIDTH/2, self.rocket.HEIGHT/2]
+        self.__enter_free_flight()
+
+    def __enter_free_flight(self):
+        # a rocket starting high enough flies analytically, the legs snap to their rest angle
+        self.free_flying = False
+        if self.free_flight is not None:
+            self.free_flight.capture()
+            if self.free_flight.clearance() >= self.free_flight_altitude:
+                self.free_flying = True
+                self.free_flight.place()
+                # nothing touches up there, the counters aren't read again until the handover
+                self.rocket.collisions = [False, False, False]
+                self.planet.collisions = [False]
+
+    def __init__(self, render_mode = 'fast', seed = rand.random(), physics_substeps = 1, action_repeat = 1, observation_views = False, profile = False, profile_info = False, trajectory_path = None, trajectory_states = False, free_flight_altitude = None, simulation_profile = "accurate", telemetry_path = None, spectator_table = None, spectator_slot = 0):
         self.running = True
-        self.screen = pygame.display.set_mode(self.WINDOW_RESOLUTION)
-        self.clock = pygame.time.Clock()
-
         self.render_mode = render_mode
+        # when set, step and reset hand out the env's own observation buffer instead of a copy,
+        # the returned array is then overwritten by the next step
+        self.observation_views = observation_views
+        # every agent step runs action_repeat frames of physics_substeps pymunk steps each
+        self.physics_substeps = physics_substeps
+        self.action_repeat = action_repeat
+        # solver settings and timestep, one of SIMULATION_PROFILES
+        self.simulation_profile = simulation_profile
+        # simulated seconds per agent step, outside of human mode
+        self.step_time = action_repeat*2*self.SIMULATION_PROFILES[simulation_profile]["timestep_scale"]/(3*self.FPS)
+        self.headless = render_mode in self.HEADLESS_MODES
+        self.screen = None
+        self.clock = None
+        if self.render_mode == "rgb_array":
+            load_pygame()
+            self.screen = pygame.Surface(self.WINDOW_RESOLUTION)
+            # its own camera, so recording never moves the view of other landers
+            self.camera = Camera([10, 10], self.WINDOW_RESOLUTION, self.RENDER_SCALE)
+        elif not self.headless:
+            load_pygame()
+            self.screen = pygame.display.set_mode(self.WINDOW_RESOLUTION)
+            self.clock = pygame.time.Clock()
+
+        self.__build_landing_scenario()
+        # When free_flight_altitude is set, the rocket flies as one analytically integrated
+        # rigid body until it comes that close to the ground, then pymunk takes over for the
+        # rest of the episode. See FreeFlight and the free_flight benchmark for the divergence.
+        if free_flight_altitude is None:
+            free_flight_altitude = self.SIMULATION_PROFILES[simulation_profile]["free_flight_altitude"]
+        self.free_flight_altitude = free_flight_altitude
+        self.free_flight = None
+        self.free_flying = False
+        if free_flight_altitude is not None:
+            self.free_flight = FreeFlight(self.rocket, self.space.gravity, self.planet.position.y - self.planet.PAD_HEIGHT/2)
+        # Profiling swaps the instrumented functions for timed wrappers on this instance only,
+        # an env built without it runs exactly the same code as before.
+        self.profiler = None
+        self.profile_info = profile_info
+        if profile:
+            self.__instrument()
+        # every episode is logged to trajectory_path, with a full state snapshot per step
+        # when trajectory_states is set, see trajectory.py for the format and replay
+        self.trajectory = None
+        if trajectory_path is not None:
+            self.__record(trajectory_path, trajectory_states)
+        # a summary of every episode goes to telemetry_path, see telemetry.py
+        self.telemetry = None
+        self.episode_return = 0.
+        self.episode_length = 0
+        if telemetry_path is not None:
+            self.__report(telemetry_path)
+        # the pose of the rocket goes to row spectator_slot of the shared spectator_table
+        # after every step, see spectator.py for watching many envs at once
+        self.pose_table = None
+        if spectator_table is not None:
+            self.__publish(spectator_table, spectator_slot)
         self.__init_landing_scenario(seed)
-        self.LANDER_INSTANCES.append(self)
+
+    def __instrument(self):
+        self.profiler = PhaseTimer()
+        timed = self.profiler.timed
+        self.step_into = timed("step", self.step_into)
+        self.handle_inputs = timed("inputs", self.handle_inputs)
+        self.rocket.update_collisions = timed("collisions", self.rocket.update_collisions)
+        self.planet.update_collisions = timed("collisions", self.planet.update_collisions)
+        self.space.step = timed("physics", self.space.step)
+        if self.free_flight is not None:
+            self.free_flight.step = timed("physics", self.free_flight.step)
+        self.__get_events = timed("events", self.__get_events)
+        self.__get_observations = timed("observations", self.__get_observations)
+        self.__get_reward = timed("reward", self.__get_reward)
+        self.render = timed("render", self.render)
+
+    def __record(self, path, record_state):
+        from trajectory import TrajectoryWriter
+        self.trajectory = TrajectoryWriter(path, record_state, self.physics_substeps, self.action_repeat, self.simulation_profile, self.observation_space.shape[0])
+        trajectory = self.trajectory
+        step_into = self.step_into
+        def recorded_step_into(action, observations):
+            reward, terminated = step_into(action, observations)
+            trajectory.add_step(self, action, observations, reward)
+            if terminated:
+                trajectory.end_episode(True)
+            return reward, terminated
+        self.step_into = recorded_step_into
+
+    def __report(self, path):
+        from telemetry import TelemetryWriter
+        self.telemetry = TelemetryWriter.open(path)
+        step_into = self.step_into
+        def reported_step_into(action, observations):
+            reward, terminated = step_into(action, observations)
+            self.episode_return += reward
+            self.episode_length += 1
+            if terminated:
+                self.telemetry.write(self.episode_return, self.episode_length, self.episode_summary())
+            return reward, terminated
+        self.step_into = reported_step_into
+
+    def __publish(self, name, slot):
+        from spectator import PoseTable
+        self.pose_table = PoseTable(name)
+        pose_table = self.pose_table
+        step_into = self.step_into
+        def published_step_into(action, observations):
+            result = step_into(action, observations)
+            pose_table.write(slot, self.pose())
+            return result
+        self.step_into = published_step_into
+
+    def perf_stats(self, reset = False):
+        if self.profiler is None:
+            return {}
+        stats = self.profiler.stats()
+        if reset:
+            self.profiler.reset()
+        return stats
+
+    # STATE SNAPSHOTS
+    # A snapshot is a flat float64 array: center of gravity, velocity, angle and angular
+    # velocity of the booster and both legs, thruster state, contact time and reward shaping,
+    # contact counts, user inputs, the last timestep, the number Chipmunk gave the booster's
+    # shape, the leg joint impulses, the episode summary, return and length so far, the
+    # FreeFlight state or NaN when pymunk flies the rocket, then the cached contacts of every
+    # pair in contact_pairs. Restoring puts the bodies, the joint impulses and the cached
+    # contacts back in place, so a restored lander continues bit for bit like the one the
+    # snapshot was taken from, down to the telemetry it reports.
+    STATE_SIZE = 48 + 6*ARBITER_SIZE
+
+    def get_state(self, state = None):
+        if state is None:
+            state = np.empty(self.STATE_SIZE)
+        if self.free_flying:
+            self.free_flight.place()
+        rocket = self.rocket
+        values = []
+        for body in [rocket, rocket.leg_body_l, rocket.leg_body_r]:
+            [vx, vy] = body.velocity
+            values += get_center(body) + [vx, vy, body.angle, body.angular_velocity]
+        values += [rocket.thruster_vector, rocket.thruster_power]
+        values += [self.contact_time, math.nan if self.prev_shaping is None else self.prev_shaping]
+        values += rocket.contact_counts() + self.planet.contact_counts()
+        values += [self.in_left, self.in_right, self.in_up]
+        values += [self.space.current_time_step, rocket.shape_id]
+        for constraint in rocket.leg_constraints:
+            if type(constraint) in JOINT_IMPULSES:
+                values += get_joint_impulse(constraint)
+        touchdown_velocity = math.nan if self.touchdown_velocity is None else self.touchdown_velocity
+        values += [self.OUTCOMES.index(self.outcome), touchdown_velocity, self.thrust_time, self.episode_return, self.episode_length]
+        values += self.free_flight.get_state() if self.free_flying else [math.nan]*6
+        values += get_arbiters(self.space, self.contact_pairs)
+        state[:] = values
+        return state
+
+    def set_state(self, state):
+        values = state.tolist()
+        rocket = self.rocket
+        if int(values[30]) != rocket.shape_id:
+            raise ValueError(f"snapshot of a rocket whose shapes Chipmunk numbered from {int(values[30])}, this one's start at {rocket.shape_id}")
+        for i, body in enumerate([rocket, rocket.leg_body_l, rocket.leg_body_r]):
+            [x, y, vx, vy, angle, angular_velocity] = values[6*i:6*i+6]
+            set_center(body, [x, y], angle)
+            body.velocity = vx, vy
+            body.angular_velocity = angular_velocity
+            body.force = 0, 0
+            body.torque = 0.
+        [rocket.thruster_vector, rocket.thruster_power] = values[18:20]
+        [self.contact_time, prev_shaping] = values[20:22]
+        self.prev_shaping = None if math.isnan(prev_shaping) else prev_shaping
+        [self.in_left, self.in_right, self.in_up] = [flag > 0 for flag in values[26:29]]
+
+        lib.cpSpaceSetCurrentTimeStep(self.space._space, values[29])
+        joints = [constraint for constraint in rocket.leg_constraints if type(constraint) in JOINT_IMPULSES]
+        for constraint, impulse in zip(joints, [values[31:33], values[33:35], values[35:36], values[36:37]]):
+            set_joint_impulse(constraint, impulse)
+        [outcome, touchdown_velocity, self.thrust_time, self.episode_return, episode_length] = values[37:42]
+        self.outcome = self.OUTCOMES[int(outcome)]
+        self.touchdown_velocity = None if math.isnan(touchdown_velocity) else touchdown_velocity
+        self.episode_length = int(episode_length)
+        # a lander free flying when the snapshot was taken goes on free flying, from exactly
+        # where it was, the others stay with pymunk whatever their altitude
+        self.free_flying = self.free_flight is not None and not math.isnan(values[42])
+        if self.free_flying:
+            self.free_flight.set_state(values[42:48])
+        set_arbiters(self.space, self.contact_pairs, values[48:], self.restored_arbiter_contacts)
+        # the first read sees the saved counts, the handlers count on from there
+        counts = [int(count) for count in values[22:26]]
+        rocket.restored_contacts = counts[0:3]
+        self.planet.restored_contacts = counts[3:4]
+        rocket.collisions = [count > 0 for count in rocket.restored_contacts]
+        self.planet.collisions = [count > 0 for count in self.planet.restored_contacts]
+        rocket.contacts[:] = counts[0:3]
+        self.planet.contacts[:] = counts[3:4]
+
+    def clone(self):
+        # a new headless lander continuing from this one's current state
+        lander = RocketLander(render_mode = None, physics_substeps = self.physics_substeps, action_repeat = self.action_repeat, observation_views = self.observation_views, free_flight_altitude = self.free_flight_altitude, simulation_profile = self.simulation_profile)
+        lander.set_state(self.get_state())
+        lander.observations[:] = self.observations
+        return lander
 
     # GYM FUNCTIONS
     def reset(self, *, seed = None, options = None):
+        if self.trajectory is not None:
+            self.trajectory.end_episode(False)
+            # a logged episode needs a seed it can be replayed from
+            if seed is None:
+                seed = rand.randrange(2**31)
+        if self.telemetry is not None and self.outcome is None and self.episode_length > 0:
+            self.telemetry.write(self.episode_return, self.episode_length, self.episode_summary())
         super().reset(seed=seed)
         self.__init_landing_scenario(seed)
-        return self.step(0)[0], {}
+        observations = self.step(0)[0]
+        # the step reset runs to fill the observations is not part of the episode
+        self.episode_return = 0.
+        self.episode_length = 0
+        if self.trajectory is not None:
+            self.trajectory.begin_episode(seed, observations)
+        return observations, {}
 
     def step(self, action):
+        reward, terminated = self.step_into(action, self.observations)
+        observations = self.observations if self.observation_views else self.observations.copy()
+        info = {}
+        # stats go out once per episode, building them every step would cost more than the step
+        if terminated:
+            info["episode_summary"] = self.episode_summary()
+            if self.profile_info:
+                info["perf_stats"] = self.perf_stats()
+        return observations, reward, terminated, False, info
+
+    def step_into(self, action, observations):
+        # same as step, but the observations are written into a caller owned float32 array
         # TRANSLATE MODEL ACTION TO CONTROL INPUTS
         self.handle_inputs(action)
 
         # RUN SIMULATION STEP
-        delta_time = self.clock.tick(self.FPS)/1000 if self.render_mode == "human" else 2/(3*self.FPS)
-        self.handle_logic(delta_time)
+        delta_time = self.clock.tick(self.FPS)/1000 if self.render_mode == "human" else self.step_time
+        terminated = self.handle_logic(delta_time)
 
         # CALCULATE OBSERVATIONS
-        observations = self.__get_observations()
+        if self.free_flying:
+            [position, velocity] = self.free_flight.booster()
+            [angle, angular_velocity] = [self.free_flight.angle, self.free_flight.angular_velocity]
+        else:
+            rocket = self.rocket
+            [position, velocity, angle, angular_velocity] = [rocket.position, rocket.velocity, rocket.angle, rocket.angular_velocity]
+        self.__get_observations(observations, position, velocity, angle, angular_velocity)
 
         # CALCULATE REWARD
-        reward, terminated = self.__get_reward(delta_time)
+        reward = self.__get_reward(position)
 
         if self.render_mode in ["human", "fast"] and self.RENDER_TOGGLE:
+            if self.free_flying:
+                self.free_flight.place()
             if self.render_mode == "human":
-                self.camera.position = self.LANDER_INSTANCES[0].rocket.position
+                self.camera.position = self.rocket.position
             self.render()
 
-        return np.array(observations, dtype=np.float32), reward, terminated, False, {}
+        return reward, terminated
+
+    def episode_summary(self):
+        # how the current episode went, outcome stays None until it terminates
+        return {
+            "outcome": self.outcome,
+            "touchdown_velocity": self.touchdown_velocity,
+            "thrust_time": self.thrust_time,
+            "thrust_impulse": self.thrust_time*self.rocket.MAX_THRUSTER_FORCE,
+        }
+
+    def pose(self):
+        # rocket pose in the Rocket.pose layout, bodies brought up to date during free flight
+        if self.free_flying:
+            self.free_flight.place()
+        return self.rocket.pose()
+
+    def close(self):
+        if self.trajectory is not None:
+            self.trajectory.close()
+            self.trajectory = None
+        if self.telemetry is not None:
+            # an episode still running when the lander closes is summarized as truncated, like reset does
+            if self.outcome is None and self.episode_length > 0:
+                self.telemetry.write(self.episode_return, self.episode_length, self.episode_summary())
+            self.telemetry.close()
+            self.telemetry = None
+        if self.pose_table is not None:
+            self.pose_table.close()
+            self.pose_table = None
 
     # GAME FUNCTIONS
     def handle_inputs(self, action):
-        if self == self.LANDER_INSTANCES[0]:
+        if not self.headless:
             for event in pygame.event.get():
                 match event.type:
                     case pygame.QUIT:
@@ -419,29 +1247,75 @@ class RocketLander(gym.Env):
     def handle_logic(self, dt):
         self.rocket.thruster_power = float(self.in_up)
         self.rocket.thruster_vector = float(self.in_left) - float(self.in_right)
-        self.rocket.thrust()
-        self.rocket.update_collisions()
-        self.planet.update_collisions()
 
-        self.space.step(dt)
+        frame_time = dt/self.action_repeat
+        substep_time = frame_time/self.physics_substeps
+        self.reward_terms.clear()
+        terminated = False
+        step_collisions = [False, False, False]
+        for frame in range(self.action_repeat):
+            # the control input is held while pymunk runs the substeps, contacts touched
+            # in any of them count for the whole frame
+            for substep in range(self.physics_substeps):
+                if self.free_flying:
+                    # no contacts to read, FreeFlight applies the thrust itself
+                    self.free_flight.step(substep_time)
+                    continue
+                self.rocket.thrust()
+                self.rocket.update_collisions(accumulate = substep > 0)
+                self.planet.update_collisions(accumulate = substep > 0)
+                self.space.step(substep_time)
+            if self.free_flying and self.free_flight.clearance() < self.free_flight_altitude:
+                # hand over to pymunk, which flies the rest of the episode
+                self.free_flight.place()
+                self.free_flying = False
+            step_collisions = [seen or collided for seen, collided in zip(step_collisions, self.rocket.collisions)]
+            [position, velocity] = self.free_flight.booster() if self.free_flying else [self.rocket.position, self.rocket.velocity]
+            terminated = self.__get_events(frame_time, position, velocity)
+            if terminated:
+                break
+        self.rocket.collisions = step_collisions
+
+        return terminated
 
     def render(self):
-        if self != self.LANDER_INSTANCES[0]:
+        if self.render_mode == "rgb_array":
+            # (height, width, 3) view straight into the offscreen surface, no pixels are
+            # copied and the next render overwrites them
+            self.draw(self.screen)
+            return pygame.surfarray.pixels3d(self.screen).swapaxes(0, 1)
+        if self.headless:
             return
-        self.screen.fill(self.BACKGROUND_COLOR)
-        self.planet.draw(self.screen, self.camera)
-        for instance in self.LANDER_INSTANCES:
-            instance.rocket.draw(self.screen, self.camera)
+        self.draw(self.screen)
         pygame.display.update()
 
-    def run(self):
+    def draw(self, display, poses = None):
+        # draws the scene on any surface, with this lander's rocket or the given Rocket.pose poses
+        display.fill(self.BACKGROUND_COLOR)
+        self.planet.draw(display, self.camera)
+        Rocket.draw_poses(display, self.camera, [self.pose()] if poses is None else poses)
+
+    def run(self, policy = None):
+        # the keyboard flies the rocket unless a policy with an act(observations) method is given
         pygame.init()
+        observations = self.observations
+        action = None
         while self.running:
-            [_, reward, terminated, _, _] = self.step(None)
+            if policy is not None:
+                action = policy.act(observations)
+            [observations, reward, terminated, _, _] = self.step(action)
             #print(reward)
-            if terminated: self.reset()
+            if terminated: observations, _ = self.reset()
         pygame.quit()
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--policy", help="NumPy policy (.npz) from numpy_policy.py flying the rocket instead of the keyboard", default=None, type=str)
+    args = parser.parse_args()
+    policy = None
+    if args.policy is not None:
+        from numpy_policy import NumpyPolicy
+        policy = NumpyPolicy(args.policy)
     lander = RocketLander(render_mode = "human")
-    lander.run()
\ No newline at end of file
+    lander.run(policy)
\ No newline at end of file
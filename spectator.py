@@ -0,0 +1,87 @@
+import argparse
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from rocket_lander import RocketLander, Rocket, Camera, load_pygame
+
+
+class PoseTable:
+
+    # A named block of shared memory with one row per env: a sequence counter followed by the
+    # rocket pose in the Rocket.pose layout. Writers make the counter odd before writing a
+    # pose and even again after, readers keep the rows whose counter was even and unchanged
+    # around their copy. Neither side ever waits on the other, a torn row is just skipped.
+    HEADER = 1
+
+    def __init__(self, name, slots = None, create = False, track = True):
+        row = self.HEADER + Rocket.POSE_SIZE
+        itemsize = np.dtype(np.float64).itemsize
+        self.owner = create
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=slots*row*itemsize)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+            if not track:
+                # a spectator only borrows the block, its exit must not unlink it
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.rows = np.ndarray((self.memory.size//(row*itemsize), row), dtype=np.float64, buffer=self.memory.buf)
+        if create:
+            self.rows[:] = 0.
+
+    def write(self, slot, pose):
+        row = self.rows[slot]
+        row[0] += 1
+        row[self.HEADER:] = pose
+        row[0] += 1
+
+    def read(self):
+        # poses of every env that published one, as a (N, POSE_SIZE) array
+        before = self.rows[:, 0].copy()
+        poses = self.rows[:, self.HEADER:].copy()
+        after = self.rows[:, 0]
+        return poses[(before == after) & (before > 0) & (before % 2 == 0)]
+
+    def close(self):
+        # the numpy view has to go before the block can be closed
+        self.rows = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def spectate(name, fps = RocketLander.FPS):
+    # Draws every rocket of the table at its own frame rate until the window is closed.
+    # Attaching and detaching is invisible to the envs, they keep writing their rows.
+    pygame = load_pygame()
+    table = PoseTable(name, track = False)
+    # a lander that is never stepped, only there to draw the planet and the rockets
+    world = RocketLander(render_mode = None)
+    world.camera = Camera([0, -250], RocketLander.WINDOW_RESOLUTION, 0.6)
+    pygame.init()
+    screen = pygame.display.set_mode(RocketLander.WINDOW_RESOLUTION)
+    pygame.display.set_caption(f"Gymulator spectator - {name}")
+    clock = pygame.time.Clock()
+    running = True
+    while running:
+        for event in pygame.event.get():
+            match event.type:
+                case pygame.QUIT:
+                    running = False
+                case pygame.MOUSEWHEEL:
+                    world.camera.scale *= 1.1 if event.y > 0 else 0.9
+        world.draw(screen, table.read())
+        pygame.display.update()
+        clock.tick(fps)
+    pygame.quit()
+    world.close()
+    table.close()
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("table", help="Name of the shared pose table, printed by the trainer", type=str)
+    parser.add_argument("-f", "--fps", help="Frame rate of the spectator window", default=RocketLander.FPS, type=int)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_arguments()
+    spectate(args.table, args.fps)
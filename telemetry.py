@@ -0,0 +1,136 @@
+import os
+import csv
+import time
+import atexit
+import threading
+import numpy as np
+
+# how an episode ended, "truncated" when it was reset before terminating
+OUTCOMES = ["truncated", "landed", "crashed", "hard_landing", "out_of_bounds"]
+EPISODE_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("return", "<f8"),
+    ("length", "<u4"),
+    ("outcome", "u1"),
+    ("touchdown_velocity", "<f8"), #nan when the legs never touched
+    ("thrust_time", "<f8"),
+])
+
+
+class EpisodeRing:
+
+    # Single producer, single consumer ring of episode records. The env only ever moves head
+    # and the flushing thread only ever moves tail, each after the records in between are in
+    # place, so the env never waits on a lock. A full ring drops the record and counts it.
+    def __init__(self, capacity):
+        self.records = np.zeros(capacity, dtype=EPISODE_DTYPE)
+        self.capacity = capacity
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def push(self, record):
+        head = self.head
+        if head - self.tail == self.capacity:
+            self.dropped += 1
+            return
+        self.records[head % self.capacity] = record
+        self.head = head + 1
+
+    def pop_all(self):
+        [tail, head] = [self.tail, self.head]
+        batch = self.records[np.arange(tail, head) % self.capacity]
+        self.tail = head
+        return batch
+
+
+class TelemetryWriter:
+
+    # Episode summaries go into a ring buffer at episode end, one thread per process flushes
+    # the rings of every writer to disk in batches. CSV files are appended to, .parquet paths
+    # get one row group per batch and need pyarrow, they are only readable once closed.
+    FLUSH_INTERVAL = 1.0 #in seconds
+    WRITERS = []
+    THREAD = None
+
+    @classmethod
+    def open(cls, path, capacity = 1024):
+        writer = cls(path, capacity)
+        cls.WRITERS.append(writer)
+        if cls.THREAD is None:
+            cls.THREAD = threading.Thread(target = cls.__flush_all, daemon = True)
+            cls.THREAD.start()
+            atexit.register(cls.close_all)
+        return writer
+
+    @classmethod
+    def __flush_all(cls):
+        while True:
+            time.sleep(cls.FLUSH_INTERVAL)
+            for writer in list(cls.WRITERS):
+                writer.flush()
+
+    @classmethod
+    def close_all(cls):
+        for writer in list(cls.WRITERS):
+            writer.close()
+
+    def __init__(self, path, capacity = 1024):
+        self.path = path
+        self.ring = EpisodeRing(capacity)
+        # only the flushing side locks, so a flush and a close never consume the ring together
+        self.lock = threading.Lock()
+        self.parquet = path.endswith(".parquet")
+        self.file = None
+        self.writer = None
+
+    def write(self, episode_return, length, summary):
+        touchdown_velocity = summary["touchdown_velocity"]
+        self.ring.push((
+            time.time(), episode_return, length,
+            OUTCOMES.index(summary["outcome"] or "truncated"),
+            np.nan if touchdown_velocity is None else touchdown_velocity,
+            summary["thrust_time"],
+        ))
+
+    def flush(self):
+        with self.lock:
+            if self.ring.head == self.ring.tail:
+                return
+            batch = self.ring.pop_all()
+            columns = {name: batch[name].tolist() for name in EPISODE_DTYPE.names}
+            columns["outcome"] = [OUTCOMES[outcome] for outcome in columns["outcome"]]
+            if self.parquet:
+                self.__write_parquet(columns)
+            else:
+                self.__write_csv(columns)
+
+    def __write_csv(self, columns):
+        if self.writer is None:
+            new = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+            self.file = open(self.path, "a", newline="")
+            self.writer = csv.writer(self.file)
+            if new:
+                self.writer.writerow(EPISODE_DTYPE.names)
+        self.writer.writerows(zip(*columns.values()))
+        self.file.flush()
+
+    def __write_parquet(self, columns):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.table(columns)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.writer is not None:
+                if self.parquet:
+                    self.writer.close()
+                else:
+                    self.file.close()
+                self.writer = None
+            if self in self.WRITERS:
+                self.WRITERS.remove(self)
@@ -1,59 +1,132 @@
 import os
-from stable_baselines3 import PPO
-from stable_baselines3.common.env_util import make_vec_env
-from stable_baselines3.common.evaluation import evaluate_policy
-from stable_baselines3.common.monitor import Monitor
+import sys
+import subprocess
 from rocket_lander import RocketLander
+from video import VideoRecorder
+from evaluator import evaluate
 import argparse
 
+# stable-baselines3, and torch with it, is only imported by the paths that learn or predict
+# with it. Worker processes import this module again when it is the main script.
+
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("mode", help="Execution mode between train or test", type=str, choices=["train","test"])
     parser.add_argument("-n", "--model_name", help="Name of the model you want to train/test", default="ppo-RocketLander", type=str)
+    parser.add_argument("-r", "--render_mode", help="Render mode of the environments, headless never opens a window, spectator opens one in its own process showing every environment", default="headless", type=str, choices=["headless","spectator"])
+    parser.add_argument("-w", "--workers", help="Number of worker processes the environments are split across, 0 steps them all in this process", default=0, type=int)
+    parser.add_argument("--pin_cpus", help="Pin every worker process to its own CPU", action="store_true")
+    parser.add_argument("-e", "--episodes", help="Largest number of test episodes", default=64, type=int)
+    parser.add_argument("--ci_width", help="Stop testing once the confidence interval of the mean reward is this narrow", default=None, type=float)
+    parser.add_argument("--record", help="Number of test episodes recorded to <model_name>.mp4", default=0, type=int)
+    parser.add_argument("-p", "--profile", help="Time the phases of every environment step and log them each rollout", action="store_true")
+    parser.add_argument("-s", "--simulation_profile", help="Solver settings of the environments, see RocketLander.SIMULATION_PROFILES", default="accurate", type=str, choices=list(RocketLander.SIMULATION_PROFILES))
+    parser.add_argument("--telemetry", help="Write a summary of every episode to <model_name>-telemetry/env<index>.<format>", default=None, type=str, choices=["csv","parquet"])
+    parser.add_argument("-t", "--trajectories", help="Directory every episode is logged to, one trajectory log per environment", default=None, type=str)
 
     return parser.parse_args()
 
 class Trainer:
 
-    def __init__(self, model_name):
+    PPO_PARAMETERS = dict(
+        n_steps = 1024,
+        batch_size = 64,
+        n_epochs = 4,
+        gamma = 0.999,
+        gae_lambda = 0.98,
+        ent_coef = 0.01,
+        verbose=1,
+        device="cuda")
+
+    def __init__(self, model_name, render_mode = "headless", workers = 0, pin_cpus = False, profile = False, trajectories = None, simulation_profile = "accurate", telemetry = None):
         self.model_name = model_name
+        self.render_mode = render_mode
+        self.workers = workers
+        self.pin_cpus = pin_cpus
+        self.profile = profile
+        self.trajectories = trajectories
+        self.simulation_profile = simulation_profile
+        self.telemetry = telemetry
+        self.pose_table = None
+
+    def make_envs(self, nenvs):
+        from stable_baselines3.common.vec_env import VecMonitor
+        from vec_env import RocketLanderVecEnv, SharedMemoryVecEnv
+        env_kwargs = dict(render_mode="headless", profile=self.profile, simulation_profile=self.simulation_profile)
+        if self.render_mode == "spectator":
+            env_kwargs["spectator_table"] = self.open_spectator(nenvs)
+        if self.trajectories is not None:
+            os.makedirs(self.trajectories, exist_ok=True)
+            env_kwargs["trajectory_path"] = os.path.join(self.trajectories, "env{index}")
+        if self.telemetry is not None:
+            os.makedirs(self.model_name+"-telemetry", exist_ok=True)
+            env_kwargs["telemetry_path"] = os.path.join(self.model_name+"-telemetry", "env{index}."+self.telemetry)
+        if self.workers > 0:
+            if nenvs % self.workers != 0:
+                raise ValueError(f"{nenvs} environments can't be split evenly across {self.workers} workers")
+            envs = SharedMemoryVecEnv(self.workers, nenvs//self.workers, cpu_affinity=self.pin_cpus or None, **env_kwargs)
+        else:
+            envs = RocketLanderVecEnv(nenvs, **env_kwargs)
+        return VecMonitor(envs)
+
+    def open_spectator(self, nenvs):
+        # The envs publish their poses to a shared table and never draw, the spectator window
+        # runs in its own process and can be closed and opened again while training goes on.
+        from spectator import PoseTable
+        name = f"gymulator-{os.getpid()}"
+        self.pose_table = PoseTable(name, nenvs, create=True)
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "spectator.py"), name]
+        subprocess.Popen(command)
+        print(f"spectating {nenvs} environments, reopen the window with: {' '.join(command)}")
+        return name
 
     def train(self, timesteps, nenvs):
-        envs = make_vec_env(RocketLander, n_envs=nenvs)
+        from stable_baselines3 import PPO
+        from callbacks import PerfStatsCallback
+        envs = self.make_envs(nenvs)
         if os.path.isfile(self.model_name+".zip"):
-            self.model = Monitor(PPO.load(self.model_name+".zip"))
+            self.model = PPO.load(self.model_name+".zip")
             self.model.set_env(envs)
             self.model.verbose = 1
             self.model_name += "v2"
         else:
-            self.model = PPO(
-            policy = 'MlpPolicy',
-            env = envs,
-            n_steps = 1024,
-            batch_size = 64,
-            n_epochs = 4,
-            gamma = 0.999,
-            gae_lambda = 0.98,
-            ent_coef = 0.01,
-            verbose=1,
-            device="cuda")
-
-        self.model.learn(total_timesteps=timesteps)
+            self.model = PPO(policy = 'MlpPolicy', env = envs, **self.PPO_PARAMETERS)
+
+        self.model.learn(total_timesteps=timesteps, callback=PerfStatsCallback() if self.profile else None)
         self.model.save(self.model_name)
+        envs.close()
+        if self.pose_table is not None:
+            self.pose_table.close()
 
-    def test(self):
-        #eval_env = Monitor(RocketLander(render_mode = "human"))
-        eval_env = make_vec_env(RocketLander, n_envs=16)
-        self.model = PPO.load(self.model_name+".zip")
+    def test(self, episodes = 64, ci_width = None):
+        # seed sharded over worker processes, each episode is appended to <model_name>-eval.jsonl
+        summary = evaluate(self.model_name+".zip", episodes, workers=self.workers or None, ci_width=ci_width, results_path=self.model_name+"-eval.jsonl", simulation_profile=self.simulation_profile)
+        print(f"mean_reward={summary['mean_reward']:.2f} +/- {summary['std_reward']} over {summary['episodes']} episodes, landing_rate={summary['landing_rate']:.2f}")
 
-        mean_reward, std_reward = evaluate_policy(self.model, eval_env, n_eval_episodes=64, deterministic=True)
-        print(f"mean_reward={mean_reward:.2f} +/- {std_reward}")
+    def record(self, episodes, max_steps = 5000):
+        # offscreen rendering, frames are encoded on a background thread while the episodes run
+        from stable_baselines3 import PPO
+        self.model = PPO.load(self.model_name+".zip")
+        env = RocketLander(render_mode = "rgb_array", simulation_profile = self.simulation_profile)
+        fps = round(1/env.step_time)
+        with VideoRecorder(self.model_name+".mp4", fps = fps) as recorder:
+            for episode in range(episodes):
+                observations, _ = env.reset(seed = episode)
+                for _ in range(max_steps):
+                    recorder.add_frame(env.render())
+                    action, _ = self.model.predict(observations, deterministic=True)
+                    observations, _, terminated, _, _ = env.step(int(action))
+                    if terminated:
+                        break
+        env.close()
 
 if __name__ == '__main__':
     args = get_arguments()
-    trainer = Trainer(args.model_name)
+    trainer = Trainer(args.model_name, args.render_mode, args.workers, args.pin_cpus, args.profile, args.trajectories, args.simulation_profile, args.telemetry)
 
     if args.mode == "train":
         trainer.train(7000000, 16)
     elif args.mode == "test":
-        trainer.test()
\ No newline at end of file
+        trainer.test(args.episodes, args.ci_width)
+        if args.record > 0:
+            trainer.record(args.record)
\ No newline at end of file
@@ -0,0 +1,216 @@
+import os
+import json
+import argparse
+import numpy as np
+from rocket_lander import RocketLander
+
+# A trajectory log is three files sharing a path prefix:
+#   <path>.json      header with the record layout and the simulation settings
+#   <path>.steps     append only fixed size step records
+#   <path>.episodes  append only fixed size episode records, written when an episode ends
+# Both record files are plain arrays of their numpy dtype and can be memory mapped as is.
+VERSION = 1
+
+def step_dtype(observation_size, state_size):
+    fields = [
+        ("episode", "<u4"),
+        ("action", "i1"), #-1 when the inputs came from the keyboard
+        ("inputs", "u1"), #up, left and right inputs as bits 0, 1 and 2
+        ("reward", "<f4"),
+        ("observation", "<f4", (observation_size,)),
+    ]
+    if state_size:
+        fields.append(("state", "<f8", (state_size,)))
+    return np.dtype(fields)
+
+def episode_dtype(observation_size):
+    return np.dtype([
+        ("seed", "<i8"),
+        ("first_step", "<u8"),
+        ("length", "<u4"),
+        ("terminated", "u1"),
+        ("return", "<f8"),
+        ("initial_observation", "<f4", (observation_size,)),
+    ])
+
+
+class TrajectoryWriter:
+
+    # Streams steps through a fixed size buffer, memory use stays the same over millions of steps.
+    BUFFER_STEPS = 4096
+
+    def __init__(self, path, record_state = False, physics_substeps = 1, action_repeat = 1, simulation_profile = "accurate", observation_size = 8):
+        self.path = path
+        self.record_state = record_state
+        header = {
+            "version": VERSION,
+            "observation_size": observation_size,
+            "state_size": RocketLander.STATE_SIZE if record_state else 0,
+            "physics_substeps": physics_substeps,
+            "action_repeat": action_repeat,
+            "simulation_profile": simulation_profile,
+        }
+        if os.path.isfile(path+".json"):
+            with open(path+".json") as file:
+                if json.load(file) != header:
+                    raise ValueError(f"{path} was logged with different settings, can't append to it")
+        else:
+            with open(path+".json", "w") as file:
+                json.dump(header, file, indent=4)
+
+        self.step_dtype = step_dtype(observation_size, header["state_size"])
+        self.episode_dtype = episode_dtype(observation_size)
+        self.steps_file = open(path+".steps", "ab")
+        self.episodes_file = open(path+".episodes", "ab")
+        self.total_steps = self.steps_file.tell()//self.step_dtype.itemsize
+        self.total_episodes = self.episodes_file.tell()//self.episode_dtype.itemsize
+        # drop a partial record left by a process that died mid write, appends stay aligned
+        self.steps_file.truncate(self.total_steps*self.step_dtype.itemsize)
+        self.episodes_file.truncate(self.total_episodes*self.episode_dtype.itemsize)
+
+        self.buffer = np.zeros(self.BUFFER_STEPS, dtype=self.step_dtype)
+        self.states = self.buffer["state"] if record_state else None
+        self.count = 0
+        self.episode = np.zeros(1, dtype=self.episode_dtype)
+        self.open = False
+
+    def begin_episode(self, seed, observation):
+        if self.open:
+            self.end_episode(False)
+        self.episode[0] = (seed, self.total_steps, 0, 0, 0., observation)
+        self.open = True
+
+    def add_step(self, lander, action, observation, reward):
+        # steps outside an episode, like the one reset runs internally, are not logged
+        if not self.open:
+            return
+        record = self.buffer[self.count]
+        record["episode"] = self.total_episodes
+        record["action"] = -1 if action is None else action
+        record["inputs"] = lander.in_up | lander.in_left << 1 | lander.in_right << 2
+        record["reward"] = reward
+        record["observation"] = observation
+        if self.states is not None:
+            lander.get_state(self.states[self.count])
+        self.count += 1
+        self.total_steps += 1
+        self.episode["length"] += 1
+        self.episode["return"] += reward
+        if self.count == self.BUFFER_STEPS:
+            self.flush()
+
+    def end_episode(self, terminated):
+        if not self.open:
+            return
+        self.episode["terminated"] = terminated
+        # the steps go to disk before the record pointing at them, a reader never maps an
+        # episode whose steps are still buffered
+        self.flush()
+        self.episodes_file.write(self.episode.view(np.uint8))
+        self.episodes_file.flush()
+        self.total_episodes += 1
+        self.open = False
+
+    def flush(self):
+        self.steps_file.write(self.buffer[:self.count].view(np.uint8))
+        self.count = 0
+        self.steps_file.flush()
+        self.episodes_file.flush()
+
+    def close(self):
+        self.end_episode(False)
+        self.flush()
+        self.steps_file.close()
+        self.episodes_file.close()
+
+
+class TrajectoryLog:
+
+    # Read only, memory mapped view of a trajectory log.
+    def __init__(self, path):
+        with open(path+".json") as file:
+            self.header = json.load(file)
+        self.step_dtype = step_dtype(self.header["observation_size"], self.header["state_size"])
+        self.episode_dtype = episode_dtype(self.header["observation_size"])
+        self.steps = self.__map(path+".steps", self.step_dtype)
+        self.episodes = self.__map(path+".episodes", self.episode_dtype)
+
+    @staticmethod
+    def __map(file_path, dtype):
+        if os.path.getsize(file_path) < dtype.itemsize:
+            return np.zeros(0, dtype=dtype)
+        # a trailing partial record is ignored, so is a log still being written
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=(os.path.getsize(file_path)//dtype.itemsize,))
+
+    @property
+    def has_states(self):
+        return self.header["state_size"] > 0
+
+    def episode(self, index):
+        record = self.episodes[index]
+        first = int(record["first_step"])
+        return record, self.steps[first:first+int(record["length"])]
+
+
+def replay(log, episode, frames = None, output = None):
+    # Re-simulates a logged episode headlessly and checks it against the log. Only the frames
+    # in [start, stop) are rendered, when states were logged the replay jumps straight to start.
+    # Replaying from the seed and jumping are both bit exact, logs of another state layout are
+    # replayed from the seed. Episodes played in human mode followed the wall clock and drift a little.
+    record, steps = log.episode(episode)
+    [start, stop] = frames if frames is not None else [0, len(steps)]
+    stop = min(stop, len(steps))
+    env = RocketLander(
+        render_mode = None if output is None else "rgb_array",
+        physics_substeps = log.header["physics_substeps"],
+        action_repeat = log.header["action_repeat"],
+        simulation_profile = log.header.get("simulation_profile", "accurate"),
+    )
+    observations, _ = env.reset(seed = int(record["seed"]))
+    first = 0
+    if start > 0 and log.has_states and log.header["state_size"] == RocketLander.STATE_SIZE:
+        env.set_state(np.array(steps["state"][start-1]))
+        first = start
+
+    recorder = None
+    if output is not None:
+        from video import VideoRecorder
+        recorder = VideoRecorder(output, fps = round(1/env.step_time))
+    divergence = None
+    max_error = 0.
+    for i in range(first, stop):
+        inputs = int(steps["inputs"][i])
+        [env.in_up, env.in_left, env.in_right] = [bool(inputs & 1), bool(inputs & 2), bool(inputs & 4)]
+        observations, reward, terminated, _, _ = env.step(None)
+        error = max(float(np.abs(observations - steps["observation"][i]).max()), abs(np.float32(reward) - steps["reward"][i]))
+        max_error = max(max_error, error)
+        if error > 0 and divergence is None:
+            divergence = i
+        if recorder is not None and i >= start:
+            recorder.add_frame(env.render())
+    if recorder is not None:
+        recorder.close()
+    env.close()
+
+    return {"episode": episode, "steps": stop-first, "first_divergence": divergence, "max_error": max_error}
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Path prefix of the trajectory log", type=str)
+    parser.add_argument("-e", "--episode", help="Episode to replay, a negative index counts from the end", default=-1, type=int)
+    parser.add_argument("-f", "--frames", help="Only render steps START:STOP of the episode", default=None, type=str)
+    parser.add_argument("-o", "--output", help="Video file the rendered frames are written to, nothing is rendered without it", default=None, type=str)
+    parser.add_argument("-l", "--list", help="List the logged episodes instead of replaying one", action="store_true")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_arguments()
+    log = TrajectoryLog(args.path)
+    if args.list:
+        for index, record in enumerate(log.episodes):
+            print(f"{index}: seed={record['seed']} length={record['length']} return={record['return']:.2f} terminated={bool(record['terminated'])}")
+    else:
+        frames = None if args.frames is None else [int(frame) for frame in args.frames.split(":")]
+        episode = args.episode % len(log.episodes)
+        print(json.dumps(replay(log, episode, frames, args.output)))
@@ -0,0 +1,181 @@
+import os
+import ctypes
+import multiprocessing as mp
+import numpy as np
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv
+from rocket_lander import RocketLander
+from workers import lander_kwargs, SharedBuffers, shared_memory_worker, STEP, RESET, CALL, CLOSE
+
+
+class RocketLanderVecEnv(VecEnv):
+
+    # Steps N landers inside a single process. Unlike a DummyVecEnv over RocketLander there
+    # are no wrappers in between: every lander writes its observation straight into its row
+    # of a preallocated (N, 8) buffer and rewards/dones land in preallocated (N,) arrays.
+
+    def __init__(self, num_envs, render_mode = None, **env_kwargs):
+        self.envs = [RocketLander(render_mode = render_mode, **lander_kwargs(env_kwargs, i)) for i in range(num_envs)]
+        env = self.envs[0]
+        super().__init__(num_envs, env.observation_space, env.action_space)
+
+        self.buf_obs = np.zeros((num_envs,) + env.observation_space.shape, dtype=np.float32)
+        self.buf_rews = np.zeros((num_envs,), dtype=np.float32)
+        self.buf_dones = np.zeros((num_envs,), dtype=bool)
+        # row views are built once so stepping never creates new array objects
+        self.obs_rows = [self.buf_obs[i] for i in range(num_envs)]
+        self.actions = []
+
+    # VECENV FUNCTIONS
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            maybe_options = {"options": self._options[i]} if self._options[i] else {}
+            self.buf_obs[i], self.reset_infos[i] = env.reset(seed=self._seeds[i], **maybe_options)
+        # seeds and options are only used once
+        self._reset_seeds()
+        self._reset_options()
+        return self.buf_obs.copy()
+
+    def step_async(self, actions):
+        # plain ints are much cheaper to match against than numpy scalars
+        self.actions = np.asarray(actions).reshape(self.num_envs).tolist()
+
+    def step_wait(self):
+        infos = [{} for _ in range(self.num_envs)]
+        for i, (env, action, observation) in enumerate(zip(self.envs, self.actions, self.obs_rows)):
+            reward, terminated = env.step_into(action, observation)
+            self.buf_rews[i] = reward
+            self.buf_dones[i] = terminated
+            if terminated:
+                # finished landers are reset in place, the last observation travels in the info
+                infos[i]["terminal_observation"] = observation.copy()
+                infos[i]["TimeLimit.truncated"] = False
+                observation[:], self.reset_infos[i] = env.reset()
+        return self.buf_obs.copy(), self.buf_rews.copy(), self.buf_dones.copy(), infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def get_attr(self, attr_name, indices = None):
+        return [getattr(env, attr_name) for env in self.__target_envs(indices)]
+
+    def set_attr(self, attr_name, value, indices = None):
+        for env in self.__target_envs(indices):
+            setattr(env, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices = None, **method_kwargs):
+        return [getattr(env, method_name)(*method_args, **method_kwargs) for env in self.__target_envs(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices = None):
+        # the landers are stepped directly, nothing is ever wrapped
+        return [False for _ in self.__target_envs(indices)]
+
+    def __target_envs(self, indices):
+        return [self.envs[i] for i in self._get_indices(indices)]
+
+
+class SharedMemoryVecEnv(VecEnv):
+
+    # Spreads the landers over a pool of worker processes. Observations, rewards and dones are
+    # written by the workers straight into shared memory, each step only costs one command
+    # byte and one acknowledgement byte per worker.
+
+    def __init__(self, num_workers, envs_per_worker = 1, cpu_affinity = None, start_method = None, render_mode = None, **env_kwargs):
+        num_envs = num_workers*envs_per_worker
+        env_kwargs["render_mode"] = render_mode
+        # a throwaway headless lander is the cheapest way to know the spaces
+        spaces_env = RocketLander(render_mode = None)
+        observation_space, action_space = spaces_env.observation_space, spaces_env.action_space
+        spaces_env.close()
+
+        if start_method is None:
+            # fork is not thread safe, same default as SubprocVecEnv
+            start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        ctx = mp.get_context(start_method)
+        if start_method == "forkserver":
+            # the fork server imports the physics modules once, every worker forked from it starts with them loaded
+            ctx.set_forkserver_preload(["workers"])
+        if cpu_affinity is True:
+            # only the CPUs this process may run on, pinning to any other fails in the worker
+            cpu_affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+
+        self.block = ctx.RawArray(ctypes.c_char, SharedBuffers.size(num_envs, observation_space.shape))
+        self.buffers = SharedBuffers(self.block, num_envs, observation_space.shape)
+        self.envs_per_worker = envs_per_worker
+        self.remotes = []
+        self.processes = []
+        for worker in range(num_workers):
+            cpu = cpu_affinity[worker % len(cpu_affinity)] if cpu_affinity else None
+            remote, work_remote = ctx.Pipe()
+            args = (work_remote, self.block, num_envs, observation_space.shape, worker*envs_per_worker, envs_per_worker, cpu, env_kwargs)
+            process = ctx.Process(target=shared_memory_worker, args=args, daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+        super().__init__(num_envs, observation_space, action_space)
+
+    # VECENV FUNCTIONS
+    def reset(self):
+        epw = self.envs_per_worker
+        for worker, remote in enumerate(self.remotes):
+            remote.send_bytes(RESET)
+            remote.send((self._seeds[worker*epw:(worker+1)*epw], self._options[worker*epw:(worker+1)*epw]))
+        for worker, remote in enumerate(self.remotes):
+            self.reset_infos[worker*epw:(worker+1)*epw] = remote.recv()
+        # seeds and options are only used once
+        self._reset_seeds()
+        self._reset_options()
+        return self.buffers.observations.copy()
+
+    def step_async(self, actions):
+        self.buffers.actions[:] = np.asarray(actions).reshape(self.num_envs)
+        for remote in self.remotes:
+            remote.send_bytes(STEP)
+
+    def step_wait(self):
+        for remote in self.remotes:
+            remote.recv_bytes()
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(self.buffers.dones):
+            infos[i]["terminal_observation"] = self.buffers.terminal_observations[i].copy()
+            infos[i]["TimeLimit.truncated"] = False
+        return self.buffers.observations.copy(), self.buffers.rewards.copy(), self.buffers.dones.copy(), infos
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send_bytes(CLOSE)
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+    def get_attr(self, attr_name, indices = None):
+        return self.__call("get_attr", attr_name, (), {}, indices)
+
+    def set_attr(self, attr_name, value, indices = None):
+        self.__call("set_attr", attr_name, (value,), {}, indices)
+
+    def env_method(self, method_name, *method_args, indices = None, **method_kwargs):
+        return self.__call("env_method", method_name, method_args, method_kwargs, indices)
+
+    def env_is_wrapped(self, wrapper_class, indices = None):
+        # the landers are stepped directly, nothing is ever wrapped
+        return [False for _ in self._get_indices(indices)]
+
+    def __call(self, operation, name, args, kwargs, indices):
+        # group the requested envs by the worker that owns them, answers come back in order
+        epw = self.envs_per_worker
+        per_worker = {}
+        for i in self._get_indices(indices):
+            per_worker.setdefault(i // epw, []).append(i % epw)
+        for worker, local_indices in per_worker.items():
+            self.remotes[worker].send_bytes(CALL)
+            self.remotes[worker].send((operation, name, args, kwargs, local_indices))
+        results = []
+        for worker in per_worker:
+            results += self.remotes[worker].recv()
+        return results
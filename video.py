@@ -0,0 +1,76 @@
+import queue
+import threading
+import numpy as np
+
+
+class VideoRecorder:
+
+    # Copies every frame into a chunk buffer and hands full chunks to a background thread
+    # that encodes them to disk, so the caller only ever pays for one frame copy. Chunk
+    # buffers are recycled and at most max_pending_chunks wait to be encoded, which keeps
+    # memory bounded however long the recording runs. Encoding uses imageio, which needs
+    # imageio-ffmpeg for mp4 files.
+    CHUNK_FRAMES = 64
+
+    def __init__(self, path, fps = 60, chunk_frames = CHUNK_FRAMES, max_pending_chunks = 8):
+        import imageio
+        self.writer = imageio.get_writer(path, fps = fps)
+        self.chunk_frames = chunk_frames
+        self.pending = queue.Queue(max_pending_chunks)
+        self.free = queue.Queue()
+        self.chunk = None
+        self.count = 0
+        self.error = None
+        self.thread = threading.Thread(target = self.__encode, daemon = True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def add_frame(self, frame):
+        if self.error is not None:
+            raise self.error
+        if self.chunk is None:
+            try:
+                self.chunk = self.free.get_nowait()
+            except queue.Empty:
+                self.chunk = np.empty((self.chunk_frames,) + frame.shape, dtype = np.uint8)
+        self.chunk[self.count] = frame
+        self.count += 1
+        if self.count == self.chunk_frames:
+            self.__flush()
+
+    def close(self):
+        if self.thread is None:
+            return
+        if self.count > 0:
+            self.__flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __flush(self):
+        # blocks only when the encoder is max_pending_chunks behind
+        self.pending.put((self.chunk, self.count))
+        self.chunk = None
+        self.count = 0
+
+    def __encode(self):
+        try:
+            while (item := self.pending.get()) is not None:
+                chunk, count = item
+                for frame in chunk[:count]:
+                    self.writer.append_data(frame)
+                self.free.put(chunk)
+        except Exception as error:
+            self.error = error
+            # keep draining so the recording thread never blocks on a dead encoder
+            while self.pending.get() is not None:
+                pass
+        finally:
+            self.writer.close()
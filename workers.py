@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from rocket_lander import RocketLander
+
+# Everything a worker process runs lives here, away from vec_env, so starting a worker
+# only imports what stepping the physics needs and never stable-baselines3 or torch.
+
+def lander_kwargs(env_kwargs, index):
+    # every env logs to its own files, "{index}" in a trajectory or telemetry path is replaced by the env index,
+    kwargs = dict(env_kwargs)
+    for name in ["trajectory_path", "telemetry_path"]:
+        if kwargs.get(name) is not None:
+            kwargs[name] = kwargs[name].format(index = index)
+    # and publishes its pose to its own row of the spectator table
+    if kwargs.get("spectator_table") is not None:
+        kwargs["spectator_slot"] = index
+    return kwargs
+
+
+class SharedBuffers:
+
+    # One flat block of shared memory split into the per step arrays every env writes to.
+    LAYOUT = [
+        ("actions", np.int64, ()),
+        ("observations", np.float32, None),
+        ("terminal_observations", np.float32, None),
+        ("rewards", np.float32, ()),
+        ("dones", np.bool_, ()),
+    ]
+
+    @classmethod
+    def size(cls, num_envs, obs_shape):
+        return sum(num_envs*int(np.prod(obs_shape if shape is None else shape))*np.dtype(dtype).itemsize for _, dtype, shape in cls.LAYOUT)
+
+    def __init__(self, block, num_envs, obs_shape):
+        offset = 0
+        for name, dtype, shape in self.LAYOUT:
+            shape = (num_envs,) + (obs_shape if shape is None else shape)
+            count = int(np.prod(shape))
+            array = np.frombuffer(block, dtype=dtype, count=count, offset=offset).reshape(shape)
+            setattr(self, name, array)
+            offset += count*np.dtype(dtype).itemsize
+
+
+# worker commands, single bytes so stepping never pickles anything
+STEP = b"s"
+RESET = b"r"
+CALL = b"m"
+CLOSE = b"c"
+DONE = b"k"
+
+def shared_memory_worker(conn, block, num_envs, obs_shape, first, count, cpu, env_kwargs):
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+    buffers = SharedBuffers(block, num_envs, obs_shape)
+    envs = [RocketLander(**lander_kwargs(env_kwargs, first+j)) for j in range(count)]
+    obs_rows = [buffers.observations[first+j] for j in range(count)]
+
+    while True:
+        command = conn.recv_bytes()
+        if command == STEP:
+            actions = buffers.actions[first:first+count].tolist()
+            for j, (env, action, observation) in enumerate(zip(envs, actions, obs_rows)):
+                reward, terminated = env.step_into(action, observation)
+                buffers.rewards[first+j] = reward
+                buffers.dones[first+j] = terminated
+                if terminated:
+                    buffers.terminal_observations[first+j] = observation
+                    observation[:], _ = env.reset()
+            conn.send_bytes(DONE)
+        elif command == RESET:
+            seeds, options = conn.recv()
+            infos = []
+            for env, observation, seed, option in zip(envs, obs_rows, seeds, options):
+                maybe_options = {"options": option} if option else {}
+                observation[:], info = env.reset(seed=seed, **maybe_options)
+                infos.append(info)
+            conn.send(infos)
+        elif command == CALL:
+            operation, name, args, kwargs, indices = conn.recv()
+            targets = [envs[j] for j in indices]
+            match operation:
+                case "get_attr":
+                    results = [getattr(env, name) for env in targets]
+                case "set_attr":
+                    results = [setattr(env, name, args[0]) for env in targets]
+                case "env_method":
+                    results = [getattr(env, name)(*args, **kwargs) for env in targets]
+            conn.send(results)
+        elif command == CLOSE:
+            for env in envs:
+                env.close()
+            conn.close()
+            break